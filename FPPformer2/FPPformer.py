@@ -26,7 +26,8 @@ class Encoder_process(nn.Module):
 
 
 class FPPformer(nn.Module):
-    def __init__(self, input_len, pred_len, encoder_layer=3, patch_size=12, d_model=4, dropout=0.05):
+    def __init__(self, input_len, pred_len, encoder_layer=3, patch_size=12, d_model=4, dropout=0.05,
+                 attn='einsum'):
         super(FPPformer, self).__init__()
         self.input_len = input_len
         self.pred_len = pred_len
@@ -39,13 +40,13 @@ class FPPformer(nn.Module):
         self.Embed1 = DataEmbedding(d_model)
         self.Embed2 = DataEmbedding(d_model, start_pos=input_len)
 
-        self.encoders = [Encoder(self.patch_size * 2 ** i, d_model, dropout)
+        self.encoders = [Encoder(self.patch_size * 2 ** i, d_model, dropout, attn)
                          for i in range(encoder_layer)]
         self.encoders = nn.ModuleList(self.encoders)
         self.encoder_process = Encoder_process(self.patch_num, self.encoder_num, self.encoders)
         self.b_patch_size = self.patch_size * 2 ** (self.encoder_num - 1)
 
-        self.decoders = [Decoder(self.patch_size * 2 ** (encoder_layer - 1 - i), d_model, dropout)
+        self.decoders = [Decoder(self.patch_size * 2 ** (encoder_layer - 1 - i), d_model, dropout, attn)
                          for i in range(encoder_layer)]
         self.decoders = nn.ModuleList(self.decoders)
         # tackle the problem when the prediction sequence length is not the multiple integer of
@@ -60,10 +61,15 @@ class FPPformer(nn.Module):
                                            )
         self.projection2 = nn.Linear(d_model, 1)
 
-    def forward(self, x, y, var_mask):
-        B, L, V = x.shape
-        self.revin(x, 'stats')
-        x_enc = self.revin(x, 'norm')
+    def encode(self, x, var_period):
+        """
+        The encoder half of forward: the embedded input, the forecast of the encoder branch and the projected
+        keys/values (memory) of the encoder outputs attended by each decoder. The memory can be reused by
+        several decode calls on the same input, e.g. with different initial forecasts y. The RevIN statistics of x
+        are returned too, nothing is stored on the model.
+        """
+        stats = self.revin(x, 'stats')
+        x_enc = self.revin(x, 'norm', stats)
         x_enc = x_enc.unsqueeze(-1)
         x_enc = self.Embed1(x_enc).transpose(1, 2)
 
@@ -71,7 +77,12 @@ class FPPformer(nn.Module):
         x_map1 = self.projection1_0(x_patch_attn).squeeze(-1)
         x_out1 = self.projection1_1(x_map1).transpose(1, 2)
 
-        x_dec = self.revin(y, 'norm')
+        memory = [self.decoders[i].project_memory(encoder_out_list[-1 - i]) for i in range(self.encoder_num)]
+        return x_enc, x_out1, memory, stats
+
+    def decode(self, y, x_enc, x_out1, memory, stats):
+        B, V = x_enc.shape[:2]
+        x_dec = self.revin(y, 'norm', stats)
         x_dec = x_dec.unsqueeze(-1)
         x_dec = self.Embed2(x_dec).transpose(1, 2). \
             expand(B, V, self.pred_len, self.d_model)  # [B V L_pred D]
@@ -82,10 +93,13 @@ class FPPformer(nn.Module):
         x_dec = x_dec.contiguous().view(B, V, -1, self.b_patch_size, self.d_model)
 
         for i in range(self.encoder_num):
-            x_dec = self.decoders[i](x_dec, encoder_out_list[-1 - i])
+            x_dec = self.decoders[i](x_dec, None, memory[i])
 
         x_map2 = self.projection2(x_dec.contiguous().view(B, V, -1, self.d_model)).squeeze(-1)
         x_out2 = x_map2.transpose(1, 2)
         x_out = x_out1 + x_out2[:, -self.pred_len:, :]
-        x_out = self.revin(x_out, 'denorm')
+        x_out = self.revin(x_out, 'denorm', stats)
         return x_out
+
+    def forward(self, x, y, var_period):
+        return self.decode(y, *self.encode(x, var_period))
@@ -3,26 +3,71 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 import numpy as np
-from utils.masking import OffDiagMask_PointLevel, OffDiagMask_PatchLevel, TriangularCausalMask
+from utils.masking import OffDiagMask_PointLevel, OffDiagMask_PatchLevel, TriangularCausalMask, Cached_Mask
 
+ATTN_BACKENDS = ['einsum', 'sdpa']
 
-class Attn_PointLevel(nn.Module):
-    def __init__(self, d_model, dropout=0.1):
-        super(Attn_PointLevel, self).__init__()
+
+def SDPA(queries, keys, values, attn_mask, dropout, scale):
+    # fused attention over the last two dimensions, attn_mask is True where attended (or None)
+    return F.scaled_dot_product_attention(queries, keys, values, attn_mask=attn_mask,
+                                          dropout_p=dropout.p if dropout.training else 0., scale=scale)
+
+
+class Attn_Projection(nn.Module):
+    # projections shared by the attention modules, keys and values share kv_projection
+    def __init__(self, d_model, dropout=0.1, attn='einsum'):
+        super(Attn_Projection, self).__init__()
+        assert attn in ATTN_BACKENDS
+        self.attn = attn
         self.query_projection = nn.Linear(d_model, d_model)
         self.kv_projection = nn.Linear(d_model, d_model)
 
         self.out_projection = nn.Linear(d_model, d_model)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, queries, keys, values, mask='Diag'):
+    def project(self, queries, keys, values, memory=None):
+        """
+        Project queries, keys and values, with one GEMM for the inputs that are the same tensor (all three in
+        self-attention, keys and values otherwise). memory is the result of project_memory for keys and values,
+        which are then not projected again.
+        """
+        if memory is not None:
+            return self.query_projection(queries), memory, memory
+        if keys is not values:
+            return self.query_projection(queries), self.kv_projection(keys), self.kv_projection(values)
+        if queries is keys:
+            weight = torch.cat([self.query_projection.weight, self.kv_projection.weight])
+            bias = torch.cat([self.query_projection.bias, self.kv_projection.bias])
+            queries, keys = F.linear(queries, weight, bias).chunk(2, dim=-1)
+            return queries, keys, keys
+        keys = self.kv_projection(keys)
+        return self.query_projection(queries), keys, keys
+
+    def project_memory(self, memory):
+        # the projected keys/values of an attended memory (e.g. an encoder output), reusable by several forwards
+        return self.kv_projection(memory)
+
+
+class Attn_PointLevel(Attn_Projection):
+    def forward(self, queries, keys, values, mask='Diag', memory=None):
         B, V, P, L, D = queries.shape
-        _, _, _, S, D = keys.shape
         scale = 1. / math.sqrt(D)
 
-        queries = self.query_projection(queries)
-        keys = self.kv_projection(keys)
-        values = self.kv_projection(values)
+        queries, keys, values = self.project(queries, keys, values, memory)
+        S = keys.shape[3]
+
+        if self.attn == 'sdpa':
+            if mask == 'Diag':
+                attn_mask = Cached_Mask('diag', L, S, queries.device, keep=True)  # [L L]
+            elif mask == 'Causal':
+                assert (L == S)
+                attn_mask = Cached_Mask('causal', L, S, queries.device, keep=True)  # [L L]
+            else:
+                attn_mask = None
+            out = SDPA(queries.reshape(B * V, P, L, D), keys.reshape(B * V, P, S, D),
+                       values.reshape(B * V, P, S, D), attn_mask, self.dropout, scale)
+            return self.out_projection(out.view(B, V, P, L, D))  # [B V P L D]
 
         scores = torch.einsum("bvpld,bvpmd->bvplm", queries, keys)  # [B V P L L]
 
@@ -42,23 +87,18 @@ class Attn_PointLevel(nn.Module):
         return self.out_projection(out)  # [B V P L D]
 
 
-class Attn_PatchLevel(nn.Module):
-    def __init__(self, d_model, dropout=0.1):
-        super(Attn_PatchLevel, self).__init__()
-        self.query_projection = nn.Linear(d_model, d_model)
-        self.kv_projection = nn.Linear(d_model, d_model)
-
-        self.out_projection = nn.Linear(d_model, d_model)
-        self.dropout = nn.Dropout(dropout)
-
-    def forward(self, queries, keys, values, mask='Diag'):
+class Attn_PatchLevel(Attn_Projection):
+    def forward(self, queries, keys, values, mask='Diag', memory=None):
         B, V, P, D = queries.shape
-        _, _, S, D = keys.shape
         scale = 1. / math.sqrt(D)
 
-        queries = self.query_projection(queries)
-        keys = self.kv_projection(keys)
-        values = self.kv_projection(values)
+        queries, keys, values = self.project(queries, keys, values, memory)
+        S = keys.shape[2]
+
+        if self.attn == 'sdpa':
+            attn_mask = Cached_Mask('diag', P, S, queries.device, keep=True) if mask == 'Diag' else None  # [P P]
+            out = SDPA(queries, keys, values, attn_mask, self.dropout, scale)
+            return self.out_projection(out)  # [B V P D]
 
         scores = torch.einsum("bvpd,bvsd->bvps", queries, keys)  # [B V P P]
         if mask == 'Diag':
@@ -73,23 +113,16 @@ class Attn_PatchLevel(nn.Module):
         return self.out_projection(out)  # [B V P D]
 
 
-class Attn_VarLevel(nn.Module):
-    def __init__(self, d_model, dropout=0.1):
-        super(Attn_VarLevel, self).__init__()
-        self.query_projection = nn.Linear(d_model, d_model)
-        self.kv_projection = nn.Linear(d_model, d_model)
-
-        self.out_projection = nn.Linear(d_model, d_model)
-        self.dropout = nn.Dropout(dropout)
-
-    def forward(self, queries, keys, values, var_mask):
+class Attn_VarLevel(Attn_Projection):
+    def forward(self, queries, keys, values, var_mask, memory=None):
         B, P, V, D = queries.shape
-        _, _, R, _ = keys.shape
         scale = 1. / math.sqrt(D)
 
-        queries = self.query_projection(queries)
-        keys = self.kv_projection(keys)
-        values = self.kv_projection(values)
+        queries, keys, values = self.project(queries, keys, values, memory)
+
+        if self.attn == 'sdpa':
+            out = SDPA(queries, keys, values, ~var_mask.unsqueeze(1), self.dropout, scale)  # [B 1 V V] mask
+            return self.out_projection(out)  # [B P V LD]
 
         scores = torch.einsum("bpvd,bprd->bpvr", queries, keys)  # [B P V V]
         var_mask = var_mask.unsqueeze(1).expand(B, P, V, V)
@@ -102,11 +135,11 @@ class Attn_VarLevel(nn.Module):
 
 
 class Encoder(nn.Module):
-    def __init__(self, patch_size, d_model, dropout=0.1):
+    def __init__(self, patch_size, d_model, dropout=0.1, attn='einsum'):
         super(Encoder, self).__init__()
         self.patch_dim = patch_size * d_model
-        self.attn1 = Attn_PointLevel(d_model, dropout)
-        self.attn2 = Attn_PatchLevel(self.patch_dim, dropout)
+        self.attn1 = Attn_PointLevel(d_model, dropout, attn)
+        self.attn2 = Attn_PatchLevel(self.patch_dim, dropout, attn)
 
         self.activation = nn.GELU()
         self.norm1 = nn.LayerNorm(self.patch_dim)
@@ -136,12 +169,12 @@ class Encoder(nn.Module):
 
 
 class Encoder_Cross(nn.Module):
-    def __init__(self, patch_size, d_model, dropout=0.1):
+    def __init__(self, patch_size, d_model, dropout=0.1, attn='einsum'):
         super(Encoder_Cross, self).__init__()
         self.patch_dim = patch_size * d_model
-        self.attn1 = Attn_PointLevel(d_model, dropout)
-        self.attn2 = Attn_PatchLevel(self.patch_dim, dropout)
-        self.attn3 = Attn_VarLevel(self.patch_dim, dropout)
+        self.attn1 = Attn_PointLevel(d_model, dropout, attn)
+        self.attn2 = Attn_PatchLevel(self.patch_dim, dropout, attn)
+        self.attn3 = Attn_VarLevel(self.patch_dim, dropout, attn)
 
         self.activation = nn.GELU()
         self.norm1 = nn.LayerNorm(self.patch_dim)
@@ -182,11 +215,11 @@ class Encoder_Cross(nn.Module):
 
 
 class Decoder(nn.Module):
-    def __init__(self, patch_size, d_model, dropout=0.1):
+    def __init__(self, patch_size, d_model, dropout=0.1, attn='einsum'):
         super(Decoder, self).__init__()
         self.patch_dim = patch_size * d_model
-        self.attn1 = Attn_PatchLevel(self.patch_dim, dropout)
-        self.attn2 = Attn_PointLevel(d_model, dropout)
+        self.attn1 = Attn_PatchLevel(self.patch_dim, dropout, attn)
+        self.attn2 = Attn_PointLevel(d_model, dropout, attn)
 
         self.activation = nn.GELU()
         self.norm1 = nn.LayerNorm(self.patch_dim)
@@ -196,10 +229,14 @@ class Decoder(nn.Module):
         self.linear1 = nn.Linear(self.patch_dim, 4 * self.patch_dim)
         self.linear2 = nn.Linear(4 * self.patch_dim, self.patch_dim)
 
-    def forward(self, x, y):
+    def project_memory(self, y):
+        # the projected keys/values of the encoder output y attended by attn1, see forward
+        return self.attn1.project_memory(y)
+
+    def forward(self, x, y, memory=None):
         B, V, P, L, D = x.shape
         x = x.contiguous().view(B, V, P, -1)
-        attn1_x = self.attn1(x, y, y, mask=None)
+        attn1_x = self.attn1(x, y, y, mask=None, memory=memory)
         x = self.norm1(x + self.dropout(attn1_x))
 
         x = x.contiguous().view(B, V, P, L, D)
@@ -2,17 +2,54 @@ import os
 import warnings
 
 import numpy as np
-import pandas as pd
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from numpy.lib.stride_tricks import sliding_window_view
 
 from sklearn.preprocessing import StandardScaler
-from utils.EMD import EMD_Reconstruct, EMD_Find_Freq, EMD_Predict
+from data.table import Read_Table, Open_Table
+from utils.EMD import EMD_Waves, EMD_Predict_Batch
+from utils.EMD_cache import EMD_Key, EMD_Cache, EMD_Append, EMD_Initial, EMD_Lazy, EMD_Stream_Key, EMD_Chunk
 warnings.filterwarnings('ignore')
 
+# Load-once registry of the process: the tables, normalized series, EMD stores and initial forecasts are built
+# by the first split that needs them and then shared (not copied) by all splits and Exp_Model instances of a run
+_registry = {}
+
+
+def Registry(key, build):
+    if key not in _registry:
+        _registry[key] = build()
+    return _registry[key]
+
+
+def Registry_Clear():
+    _registry.clear()
+
+
+def Standardize(df_value, train_end, block_size=65536):
+    # the series is kept and emitted as float32, the model computes in float32 anyway. It is normalized by blocks
+    # of rows, so that a mapped table (a Table_View of Read_Table) is never read into memory as a whole
+    scaler = StandardScaler()
+    scaler.fit(df_value[:train_end])
+    data = np.empty(df_value.shape, dtype=np.float32)
+    for start in range(0, len(df_value), block_size):
+        data[start: start + block_size] = scaler.transform(df_value[start: start + block_size])
+    return scaler, data
+
+
+def EMD_Series(scaler, df_value, data, emd_dtype='float64'):
+    # the normalized series the EMD is fitted on, normalized again in float64 unless emd_dtype is float32
+    if emd_dtype == 'float64':
+        return scaler.transform(df_value)
+    return data.astype(np.float64)
+
 
 class Dataset_ETT_hour(Dataset):
     def __init__(self, root_path, flag='train', size=None, features='S', data_path='ETTh1.csv',
-                 target='OT', ori_target='OT', EMD=True):
+                 target='OT', ori_target='OT', EMD=True,
+                 emd_workers=0, emd_chunk=256, emd_pred_mmap=False, emd_mode='emd', emd_append=False,
+                 emd_lazy=False, emd_lru=4096, emd_lazy_persist=False, emd_dtype='float64', emd_shard=None):
         # size [label_len, pred_len]
         # info
         if size is None:
@@ -27,6 +64,16 @@ class Dataset_ETT_hour(Dataset):
         self.set_type = type_map[flag]
         self.flag = flag
         self.EMD = EMD
+        self.emd_workers = emd_workers
+        self.emd_chunk = emd_chunk
+        self.emd_pred_mmap = emd_pred_mmap
+        self.emd_mode = emd_mode
+        self.emd_append = emd_append
+        self.emd_lazy = emd_lazy
+        self.emd_lru = emd_lru
+        self.emd_lazy_persist = emd_lazy_persist
+        self.emd_dtype = emd_dtype
+        self.emd_shard = emd_shard
 
         self.features = features
         self.target = target
@@ -37,136 +84,102 @@ class Dataset_ETT_hour(Dataset):
         self.__read_data__()
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        dataset_key = (os.path.abspath(os.path.join(self.root_path, self.data_path)), self.ori_target)
+        var_list, df_value = Registry(dataset_key, lambda: Read_Table(self.root_path, self.data_path,
+                                                                      self.ori_target))
 
         border1s = [0, 12 * 30 * 24 - self.input_len, 12 * 30 * 24 + 4 * 30 * 24 - self.input_len]
         border2s = [12 * 30 * 24, 12 * 30 * 24 + 4 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
 
-        cols = list(df_raw.columns)
-        cols.remove(self.ori_target)
-        cols.remove('date')
-        df_raw = df_raw[['date'] + [self.ori_target] + cols]
-        var_list = [self.ori_target] + cols
         self.target_index = var_list.index(self.target)
-        cols_data = df_raw.columns[1:]
-        df_data = df_raw[cols_data]
-        df_value = df_data.values
 
         # data standardization
-        train_data = df_value[border1s[0]:border2s[0]]
-        self.scaler.fit(train_data)
-        self.data = self.scaler.transform(df_value)
+        self.scaler, self.data = Registry(dataset_key + ('scaled', border2s[0]),
+                                          lambda: Standardize(df_value, border2s[0]))
         self.data_x = self.data[border1:border2]
 
         if self.EMD:
-            self.sin_waves = np.zeros([self.input_len + 1, self.input_len + self.pred_len])
-            self.cos_waves = np.zeros([self.input_len + 1, self.input_len + self.pred_len])
-            for i in range(self.input_len + 1):
-                if i == 0:
-                    continue
-                for j in range(self.input_len + self.pred_len):
-                    cur_period = self.input_len / i
-                    self.sin_waves[i, j] = np.sin((2 * np.pi / cur_period) * j)
-                    self.cos_waves[i, j] = np.cos((2 * np.pi / cur_period) * j)
-
-            emd_dataset_path = './EMD/' + self.data_path[:-4]
-            if not os.path.exists(emd_dataset_path):
-                os.makedirs(emd_dataset_path)
-
-            freq_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_freq.npy'.
-                         format(self.flag, self.input_len))
-            reconw_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_reconw.npy'.
-                           format(self.flag, self.input_len))
-            s_freq_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_sfreq.npy'.
-                           format(self.flag, self.input_len))
-
-            if not os.path.exists(freq_path):
-                self.emd_freq = np.zeros([len(self.data_x) - self.input_len, 40, self.data_x.shape[1]])
-                self.emd_reconstructw = np.zeros([len(self.data_x) - self.input_len, 40, self.data_x.shape[1]])
-                self.emd_sfreq = np.zeros([len(self.data_x) - self.input_len, self.data_x.shape[1]])
-                print('Finding EMD-based freqs')
-                for i in range(len(self.data_x) - self.input_len):
-                    print('{}/{}'.format(i, len(self.data_x) - self.input_len))
-                    for j in range(self.data_x.shape[1]):
-                        local_freq, s_freq = EMD_Find_Freq(self.data_x[i: i + self.input_len, j], self.input_len)
-                        self.emd_freq[i, :local_freq.shape[0], j] = local_freq
-                        self.emd_sfreq[i, j] = s_freq
-                        if local_freq.shape[0] > 0:
-                            current_sin_waves = self.sin_waves[local_freq, :self.input_len]
-                            current_cos_waves = self.cos_waves[local_freq, :self.input_len]
-                            input_features = np.concatenate([current_sin_waves, current_cos_waves], axis=0)
-                        else:
-                            input_features = None
-                        coef = EMD_Reconstruct(self.data_x[i: i + self.input_len, j], self.input_len, input_features)
-                        self.emd_reconstructw[i, :coef.shape[0], j] = coef
-
-                print('Saving EMD-based freqs ...')
-                np.save(freq_path, self.emd_freq)
-                np.save(reconw_path, self.emd_reconstructw)
-                np.save(s_freq_path, self.emd_sfreq)
+            self.sin_waves, self.cos_waves = Registry(('waves', self.input_len, self.pred_len),
+                                                      lambda: EMD_Waves(self.input_len, self.pred_len))
+            emd_key = dataset_key + ('emd', border2s[0], border2s[2], self.input_len, self.emd_mode, self.emd_dtype)
+
+            def emd_series():
+                return EMD_Series(self.scaler, df_value[:border2s[2]], self.data[:border2s[2]], self.emd_dtype)
+
+            if self.emd_lazy:
+                emd_path = None
+                if self.emd_lazy_persist:
+                    emd_path = os.path.join('./EMD/' + self.data_path[:-4], Registry(
+                        emd_key + ('key',), lambda: EMD_Key(emd_series(), self.input_len, self.emd_mode)),
+                        'lazy_{}'.format(self.pred_len))
+                self.emd_lazy_store = Registry(
+                    emd_key + ('lazy', self.pred_len, self.emd_lru, emd_path),
+                    lambda: EMD_Lazy(emd_series(), self.input_len, self.pred_len,
+                                     self.sin_waves, self.cos_waves, mode=self.emd_mode,
+                                     lru_size=self.emd_lru, cache_path=emd_path))
+                # windows are computed when first requested, indexed by absolute window start as the cache
+                self.emd_pred, self.emd_sfreq = self.emd_lazy_store.views(border1)
             else:
-                self.emd_freq = np.load(freq_path)
-                self.emd_reconstructw = np.load(reconw_path)
-                self.emd_sfreq = np.load(s_freq_path)
+                emd_key = emd_key + ('append' if self.emd_append else 'cache',)
+                if self.emd_append:
+                    self.emd_store = Registry(emd_key, lambda: EMD_Append(
+                        df_value[:border2s[2]], self.scaler, self.input_len, self.sin_waves, self.cos_waves,
+                        './EMD/' + self.data_path[:-4],
+                        num_workers=self.emd_workers, chunk_size=self.emd_chunk, mode=self.emd_mode))
+                else:
+                    self.emd_store = Registry(emd_key, lambda: EMD_Cache(
+                        emd_series(), self.input_len, self.sin_waves, self.cos_waves,
+                        './EMD/' + self.data_path[:-4],
+                        num_workers=self.emd_workers, chunk_size=self.emd_chunk, mode=self.emd_mode,
+                        shard=self.emd_shard))
+                if self.emd_store is None:
+                    # only one shard of the cache was computed (see scripts/emd_precompute.py)
+                    return
+                # the cache is indexed by absolute window start, keep the windows starting inside this split
+                self.emd_sfreq = self.emd_store.sfreq[border1:border2 - self.input_len]
+                self.emd_pred = Registry(
+                    emd_key + ('pred', self.pred_len, border1, border2, self.emd_pred_mmap),
+                    lambda: EMD_Initial(self.emd_store, border1, border1 + self.__len__(), self.input_len,
+                                        self.pred_len, self.sin_waves, self.cos_waves, mmap=self.emd_pred_mmap,
+                                        scaler=self.scaler))
 
     def __getitem__(self, index):
         r_begin = index
         r_end = r_begin + self.input_len + self.pred_len
+        # var_period holds the dominant EMD period of each variable, variables of different periods
+        # are masked from each other in the cross-variable attention
         if self.features == 'M':
             seq_x = self.data_x[r_begin:r_end]
-            pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]])
-            for i in range(seq_x.shape[1]):
-                pred_x_initial[:, i] = np.mean(seq_x[:self.input_len, i])
-
-            var_sp_matrix = np.zeros([seq_x.shape[1], seq_x.shape[1]])
             if self.EMD:
-                for i in range(seq_x.shape[1]):
-                    current_freq = self.emd_freq[index, :, i]
-                    current_weight = self.emd_reconstructw[index, :, i]
-                    pred_x_initial[:, i] = EMD_Predict(
-                        current_weight, self.input_len, self.pred_len, current_freq, self.sin_waves, self.cos_waves)
+                pred_x_initial = self.emd_pred[index]
                 if self.set_type == 0:
                     per = np.random.permutation(seq_x.shape[1])
-                    ones_matrix = np.ones([1, seq_x.shape[1]])
-                    zeros_matrix = np.zeros([1, seq_x.shape[1]])
-                    var_speriod = self.emd_sfreq[index, per].reshape(1, seq_x.shape[1])
-                    for i in range(seq_x.shape[1]):
-                        shared_period = var_speriod[0, i]
-                        var_sp_matrix[i, :] = np.where(var_speriod == shared_period, zeros_matrix, ones_matrix)
-                    return seq_x[:, per], pred_x_initial[-self.pred_len:, per], var_sp_matrix.astype(bool)
+                    return seq_x[:, per], pred_x_initial[:, per], self.emd_sfreq[index, per]
                 else:
-                    ones_matrix = np.ones([1, seq_x.shape[1]])
-                    zeros_matrix = np.zeros([1, seq_x.shape[1]])
-                    var_speriod = self.emd_sfreq[index, :].reshape(1, seq_x.shape[1])
-                    for i in range(seq_x.shape[1]):
-                        shared_period = var_speriod[0, i]
-                        var_sp_matrix[i, :] = np.where(var_speriod == shared_period, zeros_matrix, ones_matrix)
-                    return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x, pred_x_initial, self.emd_sfreq[index]
 
             else:
+                var_period = np.zeros(seq_x.shape[1], dtype=np.int16)
+                pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]], dtype=np.float32)
+                for i in range(seq_x.shape[1]):
+                    pred_x_initial[:, i] = np.mean(seq_x[:self.input_len, i])
                 if self.set_type == 0:
                     per = np.random.permutation(seq_x.shape[1])
-                    return seq_x[:, per], pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x[:, per], pred_x_initial[-self.pred_len:, per], var_period
                 else:
-                    return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x, pred_x_initial[-self.pred_len:, :], var_period
         else:
             seq_x = self.data_x[r_begin:r_end, self.target_index: self.target_index + 1]
-            pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]])
-            pred_x_initial[:, 0] = np.mean(seq_x[:self.input_len, 0])
-            var_sp_matrix = np.zeros([seq_x.shape[1], seq_x.shape[1]])
+            var_period = np.zeros(seq_x.shape[1], dtype=np.int16)
             if self.EMD:
-                current_freq = self.emd_freq[index, :, self.target_index]
-                current_weight = self.emd_reconstructw[index, :, self.target_index]
-                pred_x_initial[:, 0] = EMD_Predict(
-                    current_weight, self.input_len, self.pred_len, current_freq, self.sin_waves, self.cos_waves)
-                return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                pred_x_initial = self.emd_pred[index, :, self.target_index: self.target_index + 1]
+                return seq_x, pred_x_initial, var_period
             else:
-                return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]], dtype=np.float32)
+                pred_x_initial[:, 0] = np.mean(seq_x[:self.input_len, 0])
+                return seq_x, pred_x_initial[-self.pred_len:, :], var_period
 
     def __len__(self):
         return len(self.data_x) - self.input_len - self.pred_len + 1
@@ -174,7 +187,9 @@ class Dataset_ETT_hour(Dataset):
 
 class Dataset_ETT_min(Dataset):
     def __init__(self, root_path, flag='train', size=None,
-                 features='S', data_path='ETTm1.csv', target='OT', ori_target='OT', EMD=True):
+                 features='S', data_path='ETTm1.csv', target='OT', ori_target='OT', EMD=True,
+                 emd_workers=0, emd_chunk=256, emd_pred_mmap=False, emd_mode='emd', emd_append=False,
+                 emd_lazy=False, emd_lru=4096, emd_lazy_persist=False, emd_dtype='float64', emd_shard=None):
         # size [label_len, pred_len]
         # info
         if size is None:
@@ -189,6 +204,16 @@ class Dataset_ETT_min(Dataset):
         self.set_type = type_map[flag]
         self.flag = flag
         self.EMD = EMD
+        self.emd_workers = emd_workers
+        self.emd_chunk = emd_chunk
+        self.emd_pred_mmap = emd_pred_mmap
+        self.emd_mode = emd_mode
+        self.emd_append = emd_append
+        self.emd_lazy = emd_lazy
+        self.emd_lru = emd_lru
+        self.emd_lazy_persist = emd_lazy_persist
+        self.emd_dtype = emd_dtype
+        self.emd_shard = emd_shard
 
         self.features = features
         self.target = target
@@ -199,137 +224,102 @@ class Dataset_ETT_min(Dataset):
         self.__read_data__()
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        dataset_key = (os.path.abspath(os.path.join(self.root_path, self.data_path)), self.ori_target)
+        var_list, df_value = Registry(dataset_key, lambda: Read_Table(self.root_path, self.data_path,
+                                                                      self.ori_target))
 
         border1s = [0, 12 * 30 * 24 * 4 - self.input_len, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.input_len]
         border2s = [12 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 8 * 30 * 24 * 4]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
 
-        cols = list(df_raw.columns)
-        cols.remove(self.ori_target)
-        cols.remove('date')
-        df_raw = df_raw[['date'] + [self.ori_target] + cols]
-        var_list = [self.ori_target] + cols
         self.target_index = var_list.index(self.target)
-        cols_data = df_raw.columns[1:]
-        df_data = df_raw[cols_data]
-        df_value = df_data.values
 
         # data standardization
-        train_data = df_value[border1s[0]:border2s[0]]
-        self.scaler.fit(train_data)
-        data = self.scaler.transform(df_value)
-
-        self.data_x = data[border1:border2]
+        self.scaler, self.data = Registry(dataset_key + ('scaled', border2s[0]),
+                                          lambda: Standardize(df_value, border2s[0]))
+        self.data_x = self.data[border1:border2]
 
         if self.EMD:
-            self.sin_waves = np.zeros([self.input_len + 1, self.input_len + self.pred_len])
-            self.cos_waves = np.zeros([self.input_len + 1, self.input_len + self.pred_len])
-            for i in range(self.input_len + 1):
-                if i == 0:
-                    continue
-                for j in range(self.input_len + self.pred_len):
-                    cur_period = self.input_len / i
-                    self.sin_waves[i, j] = np.sin((2 * np.pi / cur_period) * j)
-                    self.cos_waves[i, j] = np.cos((2 * np.pi / cur_period) * j)
-
-            emd_dataset_path = './EMD/' + self.data_path[:-4]
-            if not os.path.exists(emd_dataset_path):
-                os.makedirs(emd_dataset_path)
-
-            freq_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_freq.npy'.
-                         format(self.flag, self.input_len))
-            reconw_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_reconw.npy'.
-                           format(self.flag, self.input_len))
-            s_freq_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_sfreq.npy'.
-                           format(self.flag, self.input_len))
-
-            if not os.path.exists(freq_path):
-                self.emd_freq = np.zeros([len(self.data_x) - self.input_len, 40, self.data_x.shape[1]])
-                self.emd_reconstructw = np.zeros([len(self.data_x) - self.input_len, 40, self.data_x.shape[1]])
-                self.emd_sfreq = np.zeros([len(self.data_x) - self.input_len, self.data_x.shape[1]])
-                print('Finding EMD-based freqs')
-                for i in range(len(self.data_x) - self.input_len):
-                    print('{}/{}'.format(i, len(self.data_x) - self.input_len))
-                    for j in range(self.data_x.shape[1]):
-                        local_freq, s_freq = EMD_Find_Freq(self.data_x[i: i + self.input_len, j], self.input_len)
-                        self.emd_freq[i, :local_freq.shape[0], j] = local_freq
-                        self.emd_sfreq[i, j] = s_freq
-                        if local_freq.shape[0] > 0:
-                            current_sin_waves = self.sin_waves[local_freq, :self.input_len]
-                            current_cos_waves = self.cos_waves[local_freq, :self.input_len]
-                            input_features = np.concatenate([current_sin_waves, current_cos_waves], axis=0)
-                        else:
-                            input_features = None
-                        coef = EMD_Reconstruct(self.data_x[i: i + self.input_len, j], self.input_len, input_features)
-                        self.emd_reconstructw[i, :coef.shape[0], j] = coef
-
-                print('Saving EMD-based freqs ...')
-                np.save(freq_path, self.emd_freq)
-                np.save(reconw_path, self.emd_reconstructw)
-                np.save(s_freq_path, self.emd_sfreq)
+            self.sin_waves, self.cos_waves = Registry(('waves', self.input_len, self.pred_len),
+                                                      lambda: EMD_Waves(self.input_len, self.pred_len))
+            emd_key = dataset_key + ('emd', border2s[0], border2s[2], self.input_len, self.emd_mode, self.emd_dtype)
+
+            def emd_series():
+                return EMD_Series(self.scaler, df_value[:border2s[2]], self.data[:border2s[2]], self.emd_dtype)
+
+            if self.emd_lazy:
+                emd_path = None
+                if self.emd_lazy_persist:
+                    emd_path = os.path.join('./EMD/' + self.data_path[:-4], Registry(
+                        emd_key + ('key',), lambda: EMD_Key(emd_series(), self.input_len, self.emd_mode)),
+                        'lazy_{}'.format(self.pred_len))
+                self.emd_lazy_store = Registry(
+                    emd_key + ('lazy', self.pred_len, self.emd_lru, emd_path),
+                    lambda: EMD_Lazy(emd_series(), self.input_len, self.pred_len,
+                                     self.sin_waves, self.cos_waves, mode=self.emd_mode,
+                                     lru_size=self.emd_lru, cache_path=emd_path))
+                # windows are computed when first requested, indexed by absolute window start as the cache
+                self.emd_pred, self.emd_sfreq = self.emd_lazy_store.views(border1)
             else:
-                self.emd_freq = np.load(freq_path)
-                self.emd_reconstructw = np.load(reconw_path)
-                self.emd_sfreq = np.load(s_freq_path)
+                emd_key = emd_key + ('append' if self.emd_append else 'cache',)
+                if self.emd_append:
+                    self.emd_store = Registry(emd_key, lambda: EMD_Append(
+                        df_value[:border2s[2]], self.scaler, self.input_len, self.sin_waves, self.cos_waves,
+                        './EMD/' + self.data_path[:-4],
+                        num_workers=self.emd_workers, chunk_size=self.emd_chunk, mode=self.emd_mode))
+                else:
+                    self.emd_store = Registry(emd_key, lambda: EMD_Cache(
+                        emd_series(), self.input_len, self.sin_waves, self.cos_waves,
+                        './EMD/' + self.data_path[:-4],
+                        num_workers=self.emd_workers, chunk_size=self.emd_chunk, mode=self.emd_mode,
+                        shard=self.emd_shard))
+                if self.emd_store is None:
+                    # only one shard of the cache was computed (see scripts/emd_precompute.py)
+                    return
+                # the cache is indexed by absolute window start, keep the windows starting inside this split
+                self.emd_sfreq = self.emd_store.sfreq[border1:border2 - self.input_len]
+                self.emd_pred = Registry(
+                    emd_key + ('pred', self.pred_len, border1, border2, self.emd_pred_mmap),
+                    lambda: EMD_Initial(self.emd_store, border1, border1 + self.__len__(), self.input_len,
+                                        self.pred_len, self.sin_waves, self.cos_waves, mmap=self.emd_pred_mmap,
+                                        scaler=self.scaler))
 
     def __getitem__(self, index):
         r_begin = index
         r_end = r_begin + self.input_len + self.pred_len
+        # var_period holds the dominant EMD period of each variable, variables of different periods
+        # are masked from each other in the cross-variable attention
         if self.features == 'M':
             seq_x = self.data_x[r_begin:r_end]
-            pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]])
-            for i in range(seq_x.shape[1]):
-                pred_x_initial[:, i] = np.mean(seq_x[:self.input_len, i])
-
-            var_sp_matrix = np.zeros([seq_x.shape[1], seq_x.shape[1]])
             if self.EMD:
-                for i in range(seq_x.shape[1]):
-                    current_freq = self.emd_freq[index, :, i]
-                    current_weight = self.emd_reconstructw[index, :, i]
-                    pred_x_initial[:, i] = EMD_Predict(
-                        current_weight, self.input_len, self.pred_len, current_freq, self.sin_waves, self.cos_waves)
+                pred_x_initial = self.emd_pred[index]
                 if self.set_type == 0:
                     per = np.random.permutation(seq_x.shape[1])
-                    ones_matrix = np.ones([1, seq_x.shape[1]])
-                    zeros_matrix = np.zeros([1, seq_x.shape[1]])
-                    var_speriod = self.emd_sfreq[index, per].reshape(1, seq_x.shape[1])
-                    for i in range(seq_x.shape[1]):
-                        shared_period = var_speriod[0, i]
-                        var_sp_matrix[i, :] = np.where(var_speriod == shared_period, zeros_matrix, ones_matrix)
-                    return seq_x[:, per], pred_x_initial[-self.pred_len:, per], var_sp_matrix.astype(bool)
+                    return seq_x[:, per], pred_x_initial[:, per], self.emd_sfreq[index, per]
                 else:
-                    ones_matrix = np.ones([1, seq_x.shape[1]])
-                    zeros_matrix = np.zeros([1, seq_x.shape[1]])
-                    var_speriod = self.emd_sfreq[index, :].reshape(1, seq_x.shape[1])
-                    for i in range(seq_x.shape[1]):
-                        shared_period = var_speriod[0, i]
-                        var_sp_matrix[i, :] = np.where(var_speriod == shared_period, zeros_matrix, ones_matrix)
-                    return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x, pred_x_initial, self.emd_sfreq[index]
 
             else:
+                var_period = np.zeros(seq_x.shape[1], dtype=np.int16)
+                pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]], dtype=np.float32)
+                for i in range(seq_x.shape[1]):
+                    pred_x_initial[:, i] = np.mean(seq_x[:self.input_len, i])
                 if self.set_type == 0:
                     per = np.random.permutation(seq_x.shape[1])
-                    return seq_x[:, per], pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x[:, per], pred_x_initial[-self.pred_len:, per], var_period
                 else:
-                    return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x, pred_x_initial[-self.pred_len:, :], var_period
         else:
             seq_x = self.data_x[r_begin:r_end, self.target_index: self.target_index + 1]
-            pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]])
-            pred_x_initial[:, 0] = np.mean(seq_x[:self.input_len, 0])
-            var_sp_matrix = np.zeros([seq_x.shape[1], seq_x.shape[1]])
+            var_period = np.zeros(seq_x.shape[1], dtype=np.int16)
             if self.EMD:
-                current_freq = self.emd_freq[index, :, self.target_index]
-                current_weight = self.emd_reconstructw[index, :, self.target_index]
-                pred_x_initial[:, 0] = EMD_Predict(
-                    current_weight, self.input_len, self.pred_len, current_freq, self.sin_waves, self.cos_waves)
-                return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                pred_x_initial = self.emd_pred[index, :, self.target_index: self.target_index + 1]
+                return seq_x, pred_x_initial, var_period
             else:
-                return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]], dtype=np.float32)
+                pred_x_initial[:, 0] = np.mean(seq_x[:self.input_len, 0])
+                return seq_x, pred_x_initial[-self.pred_len:, :], var_period
 
     def __len__(self):
         return len(self.data_x) - self.input_len - self.pred_len + 1
@@ -337,7 +327,9 @@ class Dataset_ETT_min(Dataset):
 
 class Dataset_Custom(Dataset):
     def __init__(self, root_path, flag='train', size=None,
-                 features='S', data_path='ECL.csv', target='MT_321', ori_target='MT_321', EMD=True):
+                 features='S', data_path='ECL.csv', target='MT_321', ori_target='MT_321', EMD=True,
+                 emd_workers=0, emd_chunk=256, emd_pred_mmap=False, emd_mode='emd', emd_append=False,
+                 emd_lazy=False, emd_lru=4096, emd_lazy_persist=False, emd_dtype='float64', emd_shard=None):
         # size [label_len, pred_len]
         # info
         if size is None:
@@ -352,6 +344,16 @@ class Dataset_Custom(Dataset):
         self.set_type = type_map[flag]
         self.flag = flag
         self.EMD = EMD
+        self.emd_workers = emd_workers
+        self.emd_chunk = emd_chunk
+        self.emd_pred_mmap = emd_pred_mmap
+        self.emd_mode = emd_mode
+        self.emd_append = emd_append
+        self.emd_lazy = emd_lazy
+        self.emd_lru = emd_lru
+        self.emd_lazy_persist = emd_lazy_persist
+        self.emd_dtype = emd_dtype
+        self.emd_shard = emd_shard
 
         self.data_path = data_path
         self.features = features
@@ -363,141 +365,394 @@ class Dataset_Custom(Dataset):
         self.__read_data__()
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
-        num_train = int(len(df_raw) * 0.7)
-        num_test = int(len(df_raw) * 0.2)
-        num_vali = len(df_raw) - num_train - num_test
-        border1s = [0, num_train - self.input_len, len(df_raw) - num_test - self.input_len]
-        border2s = [num_train, num_train + num_vali, len(df_raw)]
+        dataset_key = (os.path.abspath(os.path.join(self.root_path, self.data_path)), self.ori_target)
+        var_list, df_value = Registry(dataset_key, lambda: Read_Table(self.root_path, self.data_path,
+                                                                      self.ori_target))
+        num_train = int(len(df_value) * 0.7)
+        num_test = int(len(df_value) * 0.2)
+        num_vali = len(df_value) - num_train - num_test
+        border1s = [0, num_train - self.input_len, len(df_value) - num_test - self.input_len]
+        border2s = [num_train, num_train + num_vali, len(df_value)]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
 
-        cols = list(df_raw.columns)
-        cols.remove(self.ori_target)
-        cols.remove('date')
-        df_raw = df_raw[['date'] + [self.ori_target] + cols]
-        var_list = [self.ori_target] + cols
         self.target_index = var_list.index(self.target)
         if self.set_type == 0:
             print('Current target:', self.target)
             print('Current index:', self.target_index)
-        cols_data = df_raw.columns[1:]
-        df_data = df_raw[cols_data]
-        df_value = df_data.values
 
         # data standardization
-        train_data = df_value[border1s[0]:border2s[0]]
-        self.scaler.fit(train_data)
-        data = self.scaler.transform(df_value)
-
-        self.data_x = data[border1:border2]
+        self.scaler, self.data = Registry(dataset_key + ('scaled', border2s[0]),
+                                          lambda: Standardize(df_value, border2s[0]))
+        self.data_x = self.data[border1:border2]
         if self.EMD:
-            self.sin_waves = np.zeros([self.input_len + 1, self.input_len + self.pred_len])
-            self.cos_waves = np.zeros([self.input_len + 1, self.input_len + self.pred_len])
-            for i in range(self.input_len + 1):
-                if i == 0:
-                    continue
-                for j in range(self.input_len + self.pred_len):
-                    cur_period = self.input_len / i
-                    self.sin_waves[i, j] = np.sin((2 * np.pi / cur_period) * j)
-                    self.cos_waves[i, j] = np.cos((2 * np.pi / cur_period) * j)
-
-            emd_dataset_path = './EMD/' + self.data_path[:-4]
-            if not os.path.exists(emd_dataset_path):
-                os.makedirs(emd_dataset_path)
-
-            freq_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_freq.npy'.
-                         format(self.flag, self.input_len))
-            reconw_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_reconw.npy'.
-                           format(self.flag, self.input_len))
-            s_freq_path = ('./EMD/' + self.data_path[:-4] + '/' + '{}_{}_sfreq.npy'.
-                           format(self.flag, self.input_len))
-
-            if not os.path.exists(freq_path):
-                self.emd_freq = np.zeros([len(self.data_x) - self.input_len, 40, self.data_x.shape[1]])
-                self.emd_reconstructw = np.zeros([len(self.data_x) - self.input_len, 40, self.data_x.shape[1]])
-                self.emd_sfreq = np.zeros([len(self.data_x) - self.input_len, self.data_x.shape[1]])
-                print('Finding EMD-based freqs')
-                for i in range(len(self.data_x) - self.input_len):
-                    print('{}/{}'.format(i, len(self.data_x) - self.input_len))
-                    for j in range(self.data_x.shape[1]):
-                        local_freq, s_freq = EMD_Find_Freq(self.data_x[i: i + self.input_len, j], self.input_len)
-                        self.emd_freq[i, :local_freq.shape[0], j] = local_freq
-                        self.emd_sfreq[i, j] = s_freq
-                        if local_freq.shape[0] > 0:
-                            current_sin_waves = self.sin_waves[local_freq, :self.input_len]
-                            current_cos_waves = self.cos_waves[local_freq, :self.input_len]
-                            input_features = np.concatenate([current_sin_waves, current_cos_waves], axis=0)
-                        else:
-                            input_features = None
-                        coef = EMD_Reconstruct(self.data_x[i: i + self.input_len, j], self.input_len, input_features)
-                        self.emd_reconstructw[i, :coef.shape[0], j] = coef
-
-                print('Saving EMD-based freqs ...')
-                np.save(freq_path, self.emd_freq)
-                np.save(reconw_path, self.emd_reconstructw)
-                np.save(s_freq_path, self.emd_sfreq)
+            self.sin_waves, self.cos_waves = Registry(('waves', self.input_len, self.pred_len),
+                                                      lambda: EMD_Waves(self.input_len, self.pred_len))
+            emd_key = dataset_key + ('emd', border2s[0], border2s[2], self.input_len, self.emd_mode, self.emd_dtype)
+
+            def emd_series():
+                return EMD_Series(self.scaler, df_value[:border2s[2]], self.data[:border2s[2]], self.emd_dtype)
+
+            if self.emd_lazy:
+                emd_path = None
+                if self.emd_lazy_persist:
+                    emd_path = os.path.join('./EMD/' + self.data_path[:-4], Registry(
+                        emd_key + ('key',), lambda: EMD_Key(emd_series(), self.input_len, self.emd_mode)),
+                        'lazy_{}'.format(self.pred_len))
+                self.emd_lazy_store = Registry(
+                    emd_key + ('lazy', self.pred_len, self.emd_lru, emd_path),
+                    lambda: EMD_Lazy(emd_series(), self.input_len, self.pred_len,
+                                     self.sin_waves, self.cos_waves, mode=self.emd_mode,
+                                     lru_size=self.emd_lru, cache_path=emd_path))
+                # windows are computed when first requested, indexed by absolute window start as the cache
+                self.emd_pred, self.emd_sfreq = self.emd_lazy_store.views(border1)
             else:
-                self.emd_freq = np.load(freq_path)
-                self.emd_reconstructw = np.load(reconw_path)
-                self.emd_sfreq = np.load(s_freq_path)
+                emd_key = emd_key + ('append' if self.emd_append else 'cache',)
+                if self.emd_append:
+                    self.emd_store = Registry(emd_key, lambda: EMD_Append(
+                        df_value[:border2s[2]], self.scaler, self.input_len, self.sin_waves, self.cos_waves,
+                        './EMD/' + self.data_path[:-4],
+                        num_workers=self.emd_workers, chunk_size=self.emd_chunk, mode=self.emd_mode))
+                else:
+                    self.emd_store = Registry(emd_key, lambda: EMD_Cache(
+                        emd_series(), self.input_len, self.sin_waves, self.cos_waves,
+                        './EMD/' + self.data_path[:-4],
+                        num_workers=self.emd_workers, chunk_size=self.emd_chunk, mode=self.emd_mode,
+                        shard=self.emd_shard))
+                if self.emd_store is None:
+                    # only one shard of the cache was computed (see scripts/emd_precompute.py)
+                    return
+                # the cache is indexed by absolute window start, keep the windows starting inside this split
+                self.emd_sfreq = self.emd_store.sfreq[border1:border2 - self.input_len]
+                self.emd_pred = Registry(
+                    emd_key + ('pred', self.pred_len, border1, border2, self.emd_pred_mmap),
+                    lambda: EMD_Initial(self.emd_store, border1, border1 + self.__len__(), self.input_len,
+                                        self.pred_len, self.sin_waves, self.cos_waves, mmap=self.emd_pred_mmap,
+                                        scaler=self.scaler))
 
     def __getitem__(self, index):
         r_begin = index
         r_end = r_begin + self.input_len + self.pred_len
+        # var_period holds the dominant EMD period of each variable, variables of different periods
+        # are masked from each other in the cross-variable attention
         if self.features == 'M':
             seq_x = self.data_x[r_begin:r_end]
-            pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]])
-            for i in range(seq_x.shape[1]):
-                pred_x_initial[:, i] = np.mean(seq_x[:self.input_len, i])
-
-            var_sp_matrix = np.zeros([seq_x.shape[1], seq_x.shape[1]])
             if self.EMD:
-                for i in range(seq_x.shape[1]):
-                    current_freq = self.emd_freq[index, :, i]
-                    current_weight = self.emd_reconstructw[index, :, i]
-                    pred_x_initial[:, i] = EMD_Predict(
-                        current_weight, self.input_len, self.pred_len, current_freq, self.sin_waves, self.cos_waves)
+                pred_x_initial = self.emd_pred[index]
                 if self.set_type == 0:
                     per = np.random.permutation(seq_x.shape[1])
-                    ones_matrix = np.ones([1, seq_x.shape[1]])
-                    zeros_matrix = np.zeros([1, seq_x.shape[1]])
-                    var_speriod = self.emd_sfreq[index, per].reshape(1, seq_x.shape[1])
-                    for i in range(seq_x.shape[1]):
-                        shared_period = var_speriod[0, i]
-                        var_sp_matrix[i, :] = np.where(var_speriod == shared_period, zeros_matrix, ones_matrix)
-                    return seq_x[:, per], pred_x_initial[-self.pred_len:, per], var_sp_matrix.astype(bool)
+                    return seq_x[:, per], pred_x_initial[:, per], self.emd_sfreq[index, per]
                 else:
-                    ones_matrix = np.ones([1, seq_x.shape[1]])
-                    zeros_matrix = np.zeros([1, seq_x.shape[1]])
-                    var_speriod = self.emd_sfreq[index, :].reshape(1, seq_x.shape[1])
-                    for i in range(seq_x.shape[1]):
-                        shared_period = var_speriod[0, i]
-                        var_sp_matrix[i, :] = np.where(var_speriod == shared_period, zeros_matrix, ones_matrix)
-                    return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x, pred_x_initial, self.emd_sfreq[index]
 
             else:
+                var_period = np.zeros(seq_x.shape[1], dtype=np.int16)
+                pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]], dtype=np.float32)
+                for i in range(seq_x.shape[1]):
+                    pred_x_initial[:, i] = np.mean(seq_x[:self.input_len, i])
                 if self.set_type == 0:
                     per = np.random.permutation(seq_x.shape[1])
-                    return seq_x[:, per], pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x[:, per], pred_x_initial[-self.pred_len:, per], var_period
                 else:
-                    return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                    return seq_x, pred_x_initial[-self.pred_len:, :], var_period
         else:
             seq_x = self.data_x[r_begin:r_end, self.target_index: self.target_index + 1]
-            pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]])
-            pred_x_initial[:, 0] = np.mean(seq_x[:self.input_len, 0])
-            var_sp_matrix = np.zeros([seq_x.shape[1], seq_x.shape[1]])
+            var_period = np.zeros(seq_x.shape[1], dtype=np.int16)
             if self.EMD:
-                current_freq = self.emd_freq[index, :, self.target_index]
-                current_weight = self.emd_reconstructw[index, :, self.target_index]
-                pred_x_initial[:, 0] = EMD_Predict(
-                    current_weight, self.input_len, self.pred_len, current_freq, self.sin_waves, self.cos_waves)
-                return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                pred_x_initial = self.emd_pred[index, :, self.target_index: self.target_index + 1]
+                return seq_x, pred_x_initial, var_period
             else:
-                return seq_x, pred_x_initial[-self.pred_len:, :], var_sp_matrix.astype(bool)
+                pred_x_initial = np.zeros([self.input_len + self.pred_len, seq_x.shape[1]], dtype=np.float32)
+                pred_x_initial[:, 0] = np.mean(seq_x[:self.input_len, 0])
+                return seq_x, pred_x_initial[-self.pred_len:, :], var_period
 
     def __len__(self):
         return len(self.data_x) - self.input_len - self.pred_len + 1
+
+
+class Dataset_Batch(Dataset):
+    """
+    Whole-batch view of a Dataset_* split. Its items are batches: __getitem__ receives the window starts of a
+    batch (e.g. from torch.utils.data.BatchSampler with batch_size=None in the DataLoader) and gathers them at once
+    from a sliding-window view of data_x, returning the same (seq_x, pred_x_initial, var_period) as the per-window
+    __getitem__, stacked as float32 tensors.
+    """
+    def __init__(self, data_set):
+        self.data_set = data_set
+        self.input_len = data_set.input_len
+        self.pred_len = data_set.pred_len
+        self.windows = sliding_window_view(data_set.data_x, self.input_len + self.pred_len, axis=0)  # [N V L]
+
+    def __getitem__(self, indices):
+        data_set = self.data_set
+        indices = np.asarray(indices)
+        if data_set.features == 'M':
+            seq_x = self.windows[indices]
+        else:
+            seq_x = self.windows[indices, data_set.target_index: data_set.target_index + 1]
+        seq_x = seq_x.transpose(0, 2, 1)  # [B L V]
+        B, _, V = seq_x.shape
+
+        if data_set.EMD and data_set.features == 'M':
+            pred_x_initial = data_set.emd_pred[indices]
+            var_period = data_set.emd_sfreq[indices]
+        elif data_set.EMD:
+            pred_x_initial = data_set.emd_pred[indices, :, data_set.target_index: data_set.target_index + 1]
+            var_period = np.zeros([B, V], dtype=np.int16)
+        else:
+            pred_x_initial = np.broadcast_to(seq_x[:, :self.input_len].mean(axis=1, keepdims=True),
+                                             [B, self.pred_len, V])
+            var_period = np.zeros([B, V], dtype=np.int16)
+
+        if data_set.features == 'M' and data_set.set_type == 0:
+            per = np.argsort(np.random.rand(B, V), axis=1)  # one variable permutation per sample
+            seq_x = np.take_along_axis(seq_x, per[:, None, :], axis=2)
+            pred_x_initial = np.take_along_axis(pred_x_initial, per[:, None, :], axis=2)
+            var_period = np.take_along_axis(var_period, per, axis=1)
+
+        return torch.from_numpy(np.ascontiguousarray(seq_x, dtype=np.float32)), \
+            torch.from_numpy(np.ascontiguousarray(pred_x_initial, dtype=np.float32)), \
+            torch.from_numpy(np.ascontiguousarray(var_period))
+
+    def __len__(self):
+        return len(self.data_set)
+
+
+class Device_Loader():
+    """
+    DataLoader replacement for splits that fit on the compute device: the series, the initial forecasts and the
+    dominant periods of a Dataset_* split are moved to device once, and every batch is formed by one index-gather
+    there (with the variable permutation of the train split), yielding the same (seq_x, pred_x_initial,
+    var_period) as Dataset_Batch. The window starts come from sampler, or every window in (shuffled) order.
+    """
+    def __init__(self, data_set, device, batch_size, shuffle=False, drop_last=False, sampler=None):
+        self.data_set = data_set
+        self.device = device
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.sampler = sampler
+        self.input_len = data_set.input_len
+        self.pred_len = data_set.pred_len
+        self.windows = len(data_set)
+        self.offsets = torch.arange(self.input_len + self.pred_len, device=device)
+
+        data_x = np.asarray(data_set.data_x, dtype=np.float32)
+        if data_set.features != 'M':
+            data_x = data_x[:, data_set.target_index: data_set.target_index + 1]
+        self.data_x = torch.from_numpy(np.ascontiguousarray(data_x)).to(device)
+        self.pred_x = None
+        if data_set.EMD:
+            # lazy EMD views are computed here for the whole split
+            pred_x = np.asarray(data_set.emd_pred[np.arange(self.windows)], dtype=np.float32)
+            var_period = np.asarray(data_set.emd_sfreq[np.arange(self.windows)])
+            if data_set.features != 'M':
+                pred_x = pred_x[:, :, data_set.target_index: data_set.target_index + 1]
+                var_period = np.zeros_like(var_period[:, :1])
+            self.pred_x = torch.from_numpy(np.ascontiguousarray(pred_x)).to(device)
+            self.var_period = torch.from_numpy(np.ascontiguousarray(var_period)).to(device)
+        else:
+            self.var_period = torch.zeros([self.windows, self.data_x.shape[1]], dtype=torch.int16, device=device)
+
+    def __len__(self):
+        windows = len(self.sampler) if self.sampler is not None else self.windows
+        return windows // self.batch_size if self.drop_last else -(-windows // self.batch_size)
+
+    def __iter__(self):
+        if self.sampler is not None:
+            starts = torch.tensor(list(self.sampler), dtype=torch.long)
+        elif self.shuffle:
+            starts = torch.randperm(self.windows)
+        else:
+            starts = torch.arange(self.windows)
+        starts = starts.to(self.device)
+        for i in range(len(self)):
+            yield self.__gather__(starts[i * self.batch_size: (i + 1) * self.batch_size])
+
+    def __gather__(self, starts):
+        seq_x = self.data_x[starts.unsqueeze(1) + self.offsets]  # [B L V]
+        B, _, V = seq_x.shape
+        if self.pred_x is not None:
+            pred_x = self.pred_x[starts]
+        else:
+            pred_x = seq_x[:, :self.input_len].mean(dim=1, keepdim=True).expand(B, self.pred_len, V)
+        var_period = self.var_period[starts]
+        if self.data_set.features == 'M' and self.data_set.set_type == 0:
+            per = torch.argsort(torch.rand(B, V, device=self.device), dim=1)  # one variable permutation per sample
+            seq_x = torch.gather(seq_x, 2, per.unsqueeze(1).expand(-1, seq_x.shape[1], -1))
+            pred_x = torch.gather(pred_x, 2, per.unsqueeze(1).expand(-1, self.pred_len, -1))
+            var_period = torch.gather(var_period, 1, per)
+        return seq_x, pred_x, var_period
+
+
+class Window_Sampler(Sampler):
+    """
+    Window starts of a training epoch: every stride-th window, from a random offset in [0, stride) drawn every
+    epoch, in random order, and only budget of them (a new random subset every epoch) when budget > 0.
+    Epochs get shorter, so the validation and early stopping checks of Exp_Model.train run more often.
+    """
+    def __init__(self, data_set, stride=1, budget=0):
+        self.windows = len(data_set)
+        self.stride = max(1, stride)
+        self.budget = budget
+        # the same number of windows for every offset
+        self.count = (self.windows - self.stride) // self.stride + 1 if self.windows >= self.stride else 0
+        if budget > 0:
+            self.count = min(self.count, budget)
+
+    def __iter__(self):
+        offset = int(torch.randint(self.stride, [1]))
+        starts = torch.arange(offset, self.windows, self.stride)
+        starts = starts[torch.randperm(len(starts))[:self.count]]
+        return iter(starts.tolist())
+
+    def __len__(self):
+        return self.count
+
+
+class Dataset_Stream(IterableDataset):
+    """
+    Streaming variant of the Dataset_* classes for series longer than memory, reading the binary table of
+    data_path (see data/table.py). The split is read in chunks of chunk_len windows, each with the
+    input_len + pred_len - 1 following rows so that windows spanning the chunk boundary are kept, and normalized
+    on the fly by a scaler fitted chunk by chunk on the training rows. The train split visits its chunks in random
+    order and draws the windows from a shuffle buffer of buffer_size windows. DataLoader workers stream disjoint
+    chunks. With EMD, the periods and Lasso weights of each chunk are computed the first time it is read and saved
+    under ./EMD/<data>/stream_<key>/ (see EMD_Stream_Key), so later epochs and runs only load them.
+    """
+    def __init__(self, root_path, flag='train', size=None, features='S', data_path='ETTh1.csv',
+                 target='OT', ori_target='OT', EMD=True, emd_mode='emd', borders='custom',
+                 chunk_len=4096, buffer_size=8192):
+        # size [label_len, pred_len]
+        # info
+        if size is None:
+            self.input_len = 24 * 4
+            self.pred_len = 24 * 4
+        else:
+            self.input_len = size[0]
+            self.pred_len = size[1]
+        # init
+        assert flag in ['train', 'test', 'val']
+        type_map = {'train': 0, 'val': 1, 'test': 2}
+        self.set_type = type_map[flag]
+        self.flag = flag
+        self.EMD = EMD
+        self.emd_mode = emd_mode
+        self.borders = borders
+        self.chunk_len = chunk_len
+        self.buffer_size = buffer_size
+
+        self.features = features
+        self.target = target
+        self.ori_target = ori_target
+        self.target_index = 0
+        self.root_path = root_path
+        self.data_path = data_path
+        self.__read_data__()
+
+    def __read_data__(self):
+        table = Open_Table(self.root_path, self.data_path, self.ori_target)
+        if table is None:
+            raise FileNotFoundError('Streaming needs the binary table of {}, convert it with python -m data.table'.
+                                    format(os.path.join(self.root_path, self.data_path)))
+        var_list, self.values, self.columns = table
+        self.target_index = var_list.index(self.target)
+
+        rows = self.values.shape[0]
+        if self.borders == 'ETT_hour':
+            border1s = [0, 12 * 30 * 24 - self.input_len, 12 * 30 * 24 + 4 * 30 * 24 - self.input_len]
+            border2s = [12 * 30 * 24, 12 * 30 * 24 + 4 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24]
+        elif self.borders == 'ETT_min':
+            border1s = [0, 12 * 30 * 24 * 4 - self.input_len, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.input_len]
+            border2s = [12 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 8 * 30 * 24 * 4]
+        else:
+            num_train = int(rows * 0.7)
+            num_test = int(rows * 0.2)
+            num_vali = rows - num_train - num_test
+            border1s = [0, num_train - self.input_len, rows - num_test - self.input_len]
+            border2s = [num_train, num_train + num_vali, rows]
+        self.border1 = border1s[self.set_type]
+        self.border2 = border2s[self.set_type]
+
+        # data standardization, fitted on the training rows one chunk at a time
+        dataset_key = (os.path.abspath(os.path.join(self.root_path, self.data_path)), self.ori_target)
+        self.scaler = Registry(dataset_key + ('stream_scaler', border2s[0]), lambda: self._fit_scaler(border2s[0]))
+        if self.EMD:
+            self.sin_waves, self.cos_waves = Registry(('waves', self.input_len, self.pred_len),
+                                                      lambda: EMD_Waves(self.input_len, self.pred_len))
+            columns = self.columns if self.features == 'M' else self.columns[self.target_index: self.target_index + 1]
+            stat = os.stat(self.values.filename)
+            emd_key = EMD_Stream_Key({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}, self.scaler.mean_,
+                                     self.scaler.scale_, columns, self.input_len, self.emd_mode)
+            self.emd_path = os.path.join('./EMD/' + self.data_path[:-4], 'stream_' + emd_key)
+
+    def _fit_scaler(self, train_end):
+        scaler = StandardScaler()
+        step = self.chunk_len * 16
+        for start in range(0, train_end, step):
+            scaler.partial_fit(self.values[start: min(start + step, train_end)][:, self.columns])
+        return scaler
+
+    def _read_chunk(self, start, end):
+        # the windows starting in [start, end) of the split, with their initial forecasts and periods
+        seq_len = self.input_len + self.pred_len
+        data = self.values[self.border1 + start: self.border1 + end + seq_len - 1][:, self.columns]
+        data = self.scaler.transform(data)  # float64 for the EMD fits
+        if self.features != 'M':
+            data = data[:, self.target_index: self.target_index + 1]
+        seq_x = sliding_window_view(data.astype(np.float32), seq_len, axis=0).transpose(0, 2, 1)  # [N L V]
+        if self.EMD:
+            chunk_file = os.path.join(self.emd_path, '{}_{}.npz'.format(self.border1 + start, self.border1 + end))
+            count, freq, weight, sfreq = EMD_Chunk(data, end - start, self.input_len, self.sin_waves, self.cos_waves,
+                                                   chunk_file, self.emd_mode)
+            indptr = np.concatenate([[0], np.cumsum(count.reshape(-1))])
+            pred_x_initial = EMD_Predict_Batch(0, indptr, freq, weight,
+                                               self.sin_waves[:, self.input_len:], self.cos_waves[:, self.input_len:])
+            pred_x_initial = pred_x_initial.reshape(end - start, -1, self.pred_len).transpose(0, 2, 1)
+            pred_x_initial = pred_x_initial.astype(np.float32)
+            var_period = sfreq if self.features == 'M' else np.zeros_like(sfreq)
+        else:
+            pred_x_initial = np.broadcast_to(seq_x[:, :self.input_len].mean(axis=1, keepdims=True),
+                                             [end - start, self.pred_len, seq_x.shape[2]])
+            var_period = np.zeros([end - start, seq_x.shape[2]], dtype=np.int16)
+        return seq_x, pred_x_initial, var_period
+
+    def __iter__(self):
+        chunks = [(start, min(start + self.chunk_len, len(self))) for start in range(0, len(self), self.chunk_len)]
+        worker = get_worker_info()
+        if worker is None:
+            rng = np.random
+        else:
+            # DataLoader seeds every worker differently at every epoch
+            rng = np.random.default_rng(worker.seed % 2 ** 32)
+            chunks = chunks[worker.id::worker.num_workers]
+        if self.set_type != 0:
+            for start, end in chunks:
+                seq_x, pred_x_initial, var_period = self._read_chunk(start, end)
+                for i in range(end - start):
+                    yield seq_x[i], pred_x_initial[i], var_period[i]
+            return
+
+        buffer = []
+        for c in rng.permutation(len(chunks)):
+            seq_x, pred_x_initial, var_period = self._read_chunk(*chunks[c])
+            for i in range(seq_x.shape[0]):
+                buffer.append((seq_x[i], pred_x_initial[i], var_period[i]))
+                if len(buffer) >= self.buffer_size:
+                    yield self._permute(buffer, rng)
+        rng.shuffle(buffer)
+        while buffer:
+            yield self._permute(buffer, rng)
+
+    def _permute(self, buffer, rng):
+        # pop a random window of the buffer, with its variables permuted in the M task
+        j = int(rng.random() * len(buffer))
+        buffer[j], buffer[-1] = buffer[-1], buffer[j]
+        seq_x, pred_x_initial, var_period = buffer.pop()
+        if self.features == 'M':
+            per = rng.permutation(seq_x.shape[1])
+            return seq_x[:, per], pred_x_initial[:, per], var_period[per]
+        return seq_x, pred_x_initial, var_period
+
+    def __len__(self):
+        return self.border2 - self.border1 - self.input_len - self.pred_len + 1
@@ -1,96 +1,150 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.table import CSV_To_Table
+
+# Preprocessing of the raw Air, River, BTC and ETH sources, one subcommand per dataset:
+# python preprocess.py all --jobs 4
+# python preprocess.py air
+# A dataset is skipped when its output exists and was made from raw files with the same hashes by the same
+# PREPROCESS_VERSION (recorded in <output>.json), unless --force is given.
+PREPROCESS_VERSION = 1
+
+
+def mean_impute(values, missing):
+    # replace the missing entries of every column by the mean of its other entries
+    values = values.astype(np.float64)
+    valid = ~missing
+    mean = np.where(valid, values, 0.).sum(axis=0) / valid.sum(axis=0)
+    return np.where(valid, values, mean[np.newaxis, :])
+
+
+def hourly_align(res, date_col, start, end):
+    # the rows of res at every hour from start to end, missing hours are left empty
+    date_range = pd.date_range(start=start, end=end, freq='h')
+    res = res.drop_duplicates(subset=date_col, keep='first').set_index(date_col)
+    return date_range, res.reindex(date_range.astype('str'))
+
+
 # Air
-air = pd.read_excel('./Air/AirQualityUCI.xlsx', header=0)
-air['Date'] = air['Date'].astype('str')
-air['Time'] = air['Time'].astype('str')
-air['Date'] = air['Date'] + " " + air['Time']
-cols = list(air.columns)
-cols.remove('Time')
-cols.remove('NMHC(GT)')
-air = air[cols]
-# data -200
-cols.remove('Date')
-air_values = air[cols].values
-mean_list = []
-for i in range(air_values.shape[1]):
-    values = air_values[:, i]
-    mean_list.append(values[values > -200].mean())
-mean_list = np.array(mean_list)
-mean_list = np.expand_dims(mean_list, axis=0)
-mean_list = mean_list.repeat(air_values.shape[0], axis=0)
-air_values = np.where(air_values > -200, air_values, mean_list)
-df_air = pd.DataFrame(data=air_values, columns=[cols])
-df_air.insert(loc=0, column='date', value=air['Date'])
-df_air.to_csv('./Air/Air.csv', mode='w', header=True, index=False)
-
-
-# # River
-river = pd.read_csv('./River/RF2.csv')
-river = river.iloc[:, :9]
-river.rename(columns={"Unnamed: 0": "date"}, inplace=True)
-river.to_csv('./River/River.csv', mode='w', header=True, index=False)
+def preprocess_air(root):
+    air = pd.read_excel(os.path.join(root, 'Air/AirQualityUCI.xlsx'), header=0)
+    air['Date'] = air['Date'].astype('str') + " " + air['Time'].astype('str')
+    cols = list(air.columns)
+    cols.remove('Time')
+    cols.remove('NMHC(GT)')
+    cols.remove('Date')
+    # data -200
+    air_values = air[cols].values
+    air_values = mean_impute(air_values, ~(air_values > -200))
+    df_air = pd.DataFrame(data=air_values, columns=[cols])
+    df_air.insert(loc=0, column='date', value=air['Date'])
+    return df_air
+
+
+# River
+def preprocess_river(root):
+    river = pd.read_csv(os.path.join(root, 'River/RF2.csv'))
+    river = river.iloc[:, :9]
+    river.rename(columns={"Unnamed: 0": "date"}, inplace=True)
+    return river
+
 
 # BTC
-date_range = pd.date_range(start='2018-05-15 06:00:00', end='2022-03-01 00:00:00', freq='h')
-data = pd.DataFrame(np.random.randn(date_range.shape[0], 1), columns=list('a'))
-data["date"] = date_range.astype('str')
-
-btc = pd.read_csv('./BTC/BTC-Hourly.csv')
-btc.rename(columns={"Unnamed: 0": "date"}, inplace=True)
-btc.to_csv('./BTC/BTC.csv', mode='w', header=True, index=False)
-res = btc.sort_values(by='date', ascending=True)
-cols = list(btc.columns)
-cols.remove('date')
-cols.remove('unix')
-cols.remove('symbol')
-res = res[['date'] + cols]
-res = res.reset_index(drop=True)
-
-data = pd.merge(data, res, on='date', how = 'left')
-cols = list(data.columns)
-cols.remove('a')
-cols.remove('date')
-data = data[cols]
-df_eth = pd.DataFrame(data=data.values, columns=[cols])
-df_eth.insert(loc=0, column='date', value=date_range)
-df_eth.to_csv('./BTC/BTC.csv', mode='w', header=True, index=False)
-
-
-# # ETH
-date_range = pd.date_range(start='2017-08-17 04:00:00', end='2023-10-19 23:00:00', freq='h')
-data = pd.DataFrame(np.random.randn(date_range.shape[0], 1), columns=list('a'))
-data["Date"] = date_range.astype('str')
-
-file_root = './ETH/'
-name = 'Binance_ETHUSDT_1h (1).csv'
-names = [p_l for p_l in name.replace('_', ',').split(',')]
-data_load = pd.read_csv(file_root + name)
-cols = list(data_load.columns)
-cols.remove('Date')
-cols.remove('tradecount')
-cols.remove('Symbol')
-
-res = data_load.sort_values(by='Date', ascending=True)
-res = res[['Date'] + cols]
-res['Date'] = res['Date'].astype('str')
-res = res.reset_index(drop=True)
-
-data = pd.merge(data, res, on='Date', how = 'left')
-cols = list(data.columns)
-cols.remove('a')
-cols.remove('Date')
-data = data[cols]
-
-crypto_values = data.values
-
-mean_list = []
-for i in range(crypto_values.shape[1]):
-    values = crypto_values[:, i]
-    values[np.isnan(values)] = np.nanmean(values)
-    crypto_values[:, i] = values
-
-df_eth = pd.DataFrame(data=crypto_values, columns=[cols])
-df_eth.insert(loc=0, column='date', value=date_range)
-df_eth.to_csv('./ETH/ETH.csv', mode='w', header=True, index=False)
+def preprocess_btc(root):
+    btc = pd.read_csv(os.path.join(root, 'BTC/BTC-Hourly.csv'))
+    btc.rename(columns={"Unnamed: 0": "date"}, inplace=True)
+    cols = list(btc.columns)
+    cols.remove('date')
+    cols.remove('unix')
+    cols.remove('symbol')
+    date_range, data = hourly_align(btc[['date'] + cols], 'date', '2018-05-15 06:00:00', '2022-03-01 00:00:00')
+    df_btc = pd.DataFrame(data=data[cols].values, columns=[cols])
+    df_btc.insert(loc=0, column='date', value=date_range)
+    return df_btc
+
+
+# ETH
+def preprocess_eth(root):
+    data_load = pd.read_csv(os.path.join(root, 'ETH/Binance_ETHUSDT_1h (1).csv'))
+    cols = list(data_load.columns)
+    cols.remove('Date')
+    cols.remove('tradecount')
+    cols.remove('Symbol')
+    res = data_load[['Date'] + cols].copy()
+    res['Date'] = res['Date'].astype('str')
+    date_range, data = hourly_align(res, 'Date', '2017-08-17 04:00:00', '2023-10-19 23:00:00')
+    crypto_values = data[cols].values
+    crypto_values = mean_impute(crypto_values, np.isnan(crypto_values))
+    df_eth = pd.DataFrame(data=crypto_values, columns=[cols])
+    df_eth.insert(loc=0, column='date', value=date_range)
+    return df_eth
+
+
+datasets = {
+    'air': {'inputs': ['Air/AirQualityUCI.xlsx'], 'output': 'Air/Air.csv', 'process': preprocess_air},
+    'river': {'inputs': ['River/RF2.csv'], 'output': 'River/River.csv', 'process': preprocess_river},
+    'btc': {'inputs': ['BTC/BTC-Hourly.csv'], 'output': 'BTC/BTC.csv', 'process': preprocess_btc},
+    'eth': {'inputs': ['ETH/Binance_ETHUSDT_1h (1).csv'], 'output': 'ETH/ETH.csv', 'process': preprocess_eth},
+}
+
+
+def file_hash(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def run(name, root, force=False):
+    info = datasets[name]
+    output = os.path.join(root, info['output'])
+    stamp_path = output[:-4] + '.json'
+    stamp = {'version': PREPROCESS_VERSION,
+             'inputs': {path: file_hash(os.path.join(root, path)) for path in info['inputs']}}
+    if not force and os.path.exists(output) and os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            if json.load(f) == stamp:
+                return '{}: up to date'.format(name)
+
+    df = info['process'](root)
+    df.to_csv(output, mode='w', header=True, index=False)
+    # binary table, read by the Dataset_* classes instead of the csv file (see table.py)
+    CSV_To_Table(output)
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f, indent=2)
+    return '{}: {} rows written to {}'.format(name, len(df), output)
+
+
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--root', type=str, default=os.path.dirname(os.path.abspath(__file__)),
+                        help='folder holding the Air, River, BTC and ETH folders')
+    common.add_argument('--force', action='store_true', help='preprocess even if the output is up to date',
+                        default=False)
+    common.add_argument('--jobs', type=int, default=1, help='number of datasets preprocessed at the same time')
+
+    parser = argparse.ArgumentParser(description='Preprocess the raw data of Air, River, BTC and ETH')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in list(datasets.keys()) + ['all']:
+        subparsers.add_parser(command, parents=[common],
+                              help='preprocess {}'.format('every dataset' if command == 'all' else command))
+    args = parser.parse_args()
+
+    names = list(datasets.keys()) if args.command == 'all' else [args.command]
+    if args.jobs > 1 and len(names) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for message in executor.map(run, names, [args.root] * len(names), [args.force] * len(names)):
+                print(message)
+    else:
+        for name in names:
+            print(run(name, args.root, args.force))
@@ -0,0 +1,122 @@
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Binary columnar copy of a dataset csv: <root>/<name>_table/ holds values.npy (column-major [rows, vars]),
+# date.npy and meta.json (column names, dtype and the size/mtime of the csv it was converted from).
+# The Dataset_* classes memory-map it instead of parsing the csv when it is present and up to date.
+# python -m data.table ./data/ETT/ETTh1.csv ./data/ECL/ECL.csv
+TABLE_FORMAT = 1
+
+
+def Table_Path(csv_path):
+    return os.path.splitext(csv_path)[0] + '_table'
+
+
+def _csv_stat(csv_path):
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def CSV_To_Table(csv_path, dtype='float64'):
+    """
+    Convert csv_path (a date column followed by the variables) to its binary table next to it
+    """
+    df_raw = pd.read_csv(csv_path)
+    cols = list(df_raw.columns)
+    cols.remove('date')
+    values = np.asfortranarray(df_raw[cols].values, dtype=dtype)
+    try:
+        date = pd.to_datetime(df_raw['date']).values
+    except (ValueError, TypeError):
+        date = df_raw['date'].values.astype(str)
+
+    table_path = Table_Path(csv_path)
+    if not os.path.exists(table_path):
+        os.makedirs(table_path)
+    meta_path = os.path.join(table_path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    np.save(os.path.join(table_path, 'values.npy'), values)
+    np.save(os.path.join(table_path, 'date.npy'), date)
+    # meta.json is written last, a table without it is incomplete
+    with open(meta_path, 'w') as f:
+        json.dump({'format': TABLE_FORMAT, 'columns': cols, 'rows': values.shape[0], 'dtype': str(values.dtype),
+                   'date_dtype': str(date.dtype), 'source': _csv_stat(csv_path)}, f, indent=2)
+    return table_path
+
+
+def Open_Table(root_path, data_path, ori_target):
+    """
+    Memory-map the binary table of a dataset if it is up to date with the csv (or the csv is gone)
+    :return: the variable names with ori_target first, the mapped values [rows, all vars] and the columns of the
+    variables in it, or None without an up-to-date table
+    """
+    csv_path = os.path.join(root_path, data_path)
+    meta_path = os.path.join(Table_Path(csv_path), 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['format'] != TABLE_FORMAT or (os.path.exists(csv_path) and meta['source'] != _csv_stat(csv_path)):
+        print('Binary table of {} is out of date, reading the csv'.format(data_path))
+        return None
+
+    values = np.load(os.path.join(Table_Path(csv_path), 'values.npy'), mmap_mode='r')
+    cols = list(meta['columns'])
+    cols.remove(ori_target)
+    var_list = [ori_target] + cols
+    return var_list, values, [meta['columns'].index(col) for col in var_list]
+
+
+class Table_View():
+    """
+    The memory-mapped values of a table with its columns in var_list order. Slicing rows reads (and copies) only
+    those rows, the table is never loaded as a whole.
+    """
+    def __init__(self, values, columns):
+        self.values = values
+        self.columns = np.asarray(columns)
+        self.shape = (values.shape[0], len(columns))
+        self.ndim = 2
+        self.dtype = values.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        return self.values[rows][..., self.columns]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+def Read_Table(root_path, data_path, ori_target):
+    """
+    Read the variables of a dataset with ori_target moved to the first column, from its binary table when it
+    is up to date with the csv (or the csv is gone), otherwise from the csv
+    :return: the variable names and the values [rows, vars], a Table_View of the mapped table if there is one
+    """
+    table = Open_Table(root_path, data_path, ori_target)
+    if table is None:
+        df_raw = pd.read_csv(os.path.join(root_path, data_path))
+        cols = list(df_raw.columns)
+        cols.remove(ori_target)
+        cols.remove('date')
+        var_list = [ori_target] + cols
+        return var_list, df_raw[var_list].values
+
+    var_list, values, columns = table
+    return var_list, Table_View(values, columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert dataset csv files to binary tables')
+    parser.add_argument('csv', type=str, nargs='+', help='csv files to convert')
+    parser.add_argument('--dtype', type=str, default='float64', help='dtype of the stored values')
+    args = parser.parse_args()
+    for csv_path in args.csv:
+        print('{} -> {}'.format(csv_path, CSV_To_Table(csv_path, args.dtype)))
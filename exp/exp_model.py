@@ -1,16 +1,17 @@
-from data.data_loader import Dataset_ETT_hour, Dataset_ETT_min, Dataset_Custom
+from data.data_loader import Dataset_ETT_hour, Dataset_ETT_min, Dataset_Custom, Dataset_Batch, Dataset_Stream, \
+    Window_Sampler, Device_Loader
 from exp.exp_basic import Exp_Basic
 from FPPformer2.FPPformer import FPPformer
 from FPPformer2.FPPformer_Cross import FPPformer_Cross
 
-from utils.tools import EarlyStopping, adjust_learning_rate
+from utils.tools import EarlyStopping, Prefetcher, adjust_learning_rate
 from utils.metrics import metric
 
 import numpy as np
 import torch
 import torch.nn as nn
 from torch import optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import os
 import time
 
@@ -19,6 +20,63 @@ import warnings
 warnings.filterwarnings('ignore')
 
 
+def Get_Dataset(args, flag):
+    # the Dataset_* split of args.data, built outside Exp_Model e.g. to load the data before forking
+    data_dict = {
+        'ETTh1': Dataset_ETT_hour,
+        'ETTh2': Dataset_ETT_hour,
+        'ETTm1': Dataset_ETT_min,
+        'ETTm2': Dataset_ETT_min,
+        'weather': Dataset_Custom,
+        'ECL': Dataset_Custom,
+        'Solar': Dataset_Custom,
+        'Traffic': Dataset_Custom,
+        'Air': Dataset_Custom,
+        'River': Dataset_Custom,
+        'BTC': Dataset_Custom,
+        'ETH': Dataset_Custom
+    }
+    Data = data_dict[args.data]
+
+    size = [args.input_len, args.pred_len]
+    if args.stream:
+        borders = {Dataset_ETT_hour: 'ETT_hour', Dataset_ETT_min: 'ETT_min', Dataset_Custom: 'custom'}[Data]
+        return Dataset_Stream(
+            root_path=args.root_path,
+            data_path=args.data_path,
+            flag=flag,
+            size=size,
+            features=args.features,
+            target=args.target,
+            ori_target=args.ori_target,
+            EMD=args.EMD,
+            emd_mode=args.emd_mode,
+            borders=borders,
+            chunk_len=args.stream_chunk,
+            buffer_size=args.stream_buffer
+        )
+    data_set = Data(
+        root_path=args.root_path,
+        data_path=args.data_path,
+        flag=flag,
+        size=size,
+        features=args.features,
+        target=args.target,
+        ori_target=args.ori_target,
+        EMD=args.EMD,
+        emd_workers=args.emd_workers,
+        emd_chunk=args.emd_chunk,
+        emd_pred_mmap=args.emd_pred_mmap,
+        emd_mode=args.emd_mode,
+        emd_append=args.emd_append,
+        emd_lazy=args.emd_lazy,
+        emd_lru=args.emd_lru,
+        emd_lazy_persist=args.emd_lazy_persist,
+        emd_dtype=args.emd_dtype
+    )
+    return data_set
+
+
 class Exp_Model(Exp_Basic):
     def __init__(self, args):
         super(Exp_Model, self).__init__(args)
@@ -31,7 +89,8 @@ class Exp_Model(Exp_Basic):
                 self.args.encoder_layer,
                 self.args.patch_size,
                 self.args.d_model,
-                self.args.dropout
+                self.args.dropout,
+                self.args.attn
             ).float()
         else:
             model = FPPformer(
@@ -40,29 +99,17 @@ class Exp_Model(Exp_Basic):
                 self.args.encoder_layer,
                 self.args.patch_size,
                 self.args.d_model,
-                self.args.dropout
+                self.args.dropout,
+                self.args.attn
             ).float()
+        if self.args.compile:
+            # fullgraph: the forward compiles without graph breaks; the parameters and checkpoints stay those of
+            # the eager model
+            model.forward = torch.compile(model.forward, fullgraph=True)
         return model
 
     def _get_data(self, flag):
         args = self.args
-        data_dict = {
-            'ETTh1': Dataset_ETT_hour,
-            'ETTh2': Dataset_ETT_hour,
-            'ETTm1': Dataset_ETT_min,
-            'ETTm2': Dataset_ETT_min,
-            'weather': Dataset_Custom,
-            'ECL': Dataset_Custom,
-            'Solar': Dataset_Custom,
-            'Traffic': Dataset_Custom,
-            'Air': Dataset_Custom,
-            'River': Dataset_Custom,
-            'BTC': Dataset_Custom,
-            'ETH': Dataset_Custom
-        }
-        Data = data_dict[self.args.data]
-
-        size = [args.input_len, args.pred_len]
         if flag == 'train':
             shuffle_flag = True
             drop_last = True
@@ -72,23 +119,54 @@ class Exp_Model(Exp_Basic):
             drop_last = True
             batch_size = args.batch_size
 
-        data_set = Data(
-            root_path=args.root_path,
-            data_path=args.data_path,
-            flag=flag,
-            size=size,
-            features=args.features,
-            target=args.target,
-            ori_target=args.ori_target,
-            EMD=args.EMD
-        )
+        data_set = Get_Dataset(args, flag)
         print(flag, len(data_set))
-        data_loader = DataLoader(
-            data_set,
-            batch_size=batch_size,
-            shuffle=shuffle_flag,
-            num_workers=args.num_workers,
-            drop_last=drop_last)
+        # with lazy EMD every worker keeps its own LRU, which would be lost if the workers were restarted per epoch
+        persistent_workers = args.EMD and args.emd_lazy and args.num_workers > 0
+        if args.device_data and not args.stream:
+            # the split is moved to the device once and batches are gathered there, without DataLoader
+            sampler = None
+            if flag == 'train' and (args.train_stride > 1 or args.epoch_windows > 0):
+                sampler = Window_Sampler(data_set, args.train_stride, args.epoch_windows)
+            data_loader = Device_Loader(data_set, self.device, batch_size, shuffle_flag, drop_last, sampler)
+            return data_set, Prefetcher(data_loader, depth=0)
+        if args.stream:
+            # Dataset_Stream shuffles the train split itself
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                num_workers=args.num_workers,
+                drop_last=drop_last)
+        elif args.batch_windows:
+            # the sampler yields the window starts of a whole batch, which Dataset_Batch gathers at once
+            sampler = RandomSampler(data_set) if shuffle_flag else SequentialSampler(data_set)
+            if flag == 'train' and (args.train_stride > 1 or args.epoch_windows > 0):
+                sampler = Window_Sampler(data_set, args.train_stride, args.epoch_windows)
+            data_loader = DataLoader(
+                Dataset_Batch(data_set),
+                sampler=BatchSampler(sampler, batch_size, drop_last),
+                batch_size=None,
+                num_workers=args.num_workers,
+                persistent_workers=persistent_workers)
+        elif flag == 'train' and (args.train_stride > 1 or args.epoch_windows > 0):
+            # strided and/or subsampled training epochs
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                sampler=Window_Sampler(data_set, args.train_stride, args.epoch_windows),
+                num_workers=args.num_workers,
+                drop_last=drop_last,
+                persistent_workers=persistent_workers)
+        else:
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                num_workers=args.num_workers,
+                drop_last=drop_last,
+                persistent_workers=persistent_workers)
+        # batches are assembled on a background thread while the model computes
+        data_loader = Prefetcher(data_loader, depth=args.prefetch, pin_memory=args.use_gpu)
 
         return data_set, data_loader
 
@@ -100,8 +178,8 @@ class Exp_Model(Exp_Basic):
         self.model.eval()
         total_loss = []
         with torch.no_grad():
-            for i, (batch_x, pred_x, var_mask) in enumerate(vali_loader):
-                pred, true = self._process_one_batch(batch_x, pred_x, var_mask)
+            for i, (batch_x, pred_x, var_period) in enumerate(vali_loader):
+                pred, true = self._process_one_batch(batch_x, pred_x, var_period)
                 loss = torch.mean((pred - true) ** 2).detach().cpu().numpy()
                 total_loss.append(loss)
             total_loss = np.average(total_loss)
@@ -130,10 +208,10 @@ class Exp_Model(Exp_Basic):
             iter_count = 0
             self.model.train()
             epoch_time = time.time()
-            for i, (batch_x, pred_x, var_mask) in enumerate(train_loader):
+            for i, (batch_x, pred_x, var_period) in enumerate(train_loader):
                 model_optim.zero_grad()
                 iter_count += 1
-                pred, true = self._process_one_batch(batch_x, pred_x, var_mask)
+                pred, true = self._process_one_batch(batch_x, pred_x, var_period)
                 loss = torch.mean((pred - true) ** 2) + torch.mean(abs(pred - true))
                 loss.backward(loss)
                 model_optim.step()
@@ -147,7 +225,10 @@ class Exp_Model(Exp_Basic):
                     iter_count = 0
                     time_now = time.time()
 
-            print("Epoch: {} cost time: {}".format(epoch + 1, time.time() - epoch_time))
+            epoch_cost = time.time() - epoch_time
+            print("Epoch: {} cost time: {}".format(epoch + 1, epoch_cost))
+            print("\tdata wait: {:.4f}s ({:.1%} of the epoch)".format(
+                train_loader.wait_time, train_loader.wait_time / epoch_cost))
 
             vali_loss = self.vali(vali_data, vali_loader)
             test_loss = self.vali(test_data, test_loader)
@@ -180,8 +261,8 @@ class Exp_Model(Exp_Basic):
             preds = []
             trues = []
             with torch.no_grad():
-                for i, (batch_x, pred_x, var_mask) in enumerate(test_loader):
-                    pred, true = self._process_one_batch(batch_x, pred_x, var_mask)
+                for i, (batch_x, pred_x, var_period) in enumerate(test_loader):
+                    pred, true = self._process_one_batch(batch_x, pred_x, var_period)
                     pred = pred.detach().cpu().numpy()
                     true = true.detach().cpu().numpy()
                     preds.append(pred)
@@ -209,8 +290,8 @@ class Exp_Model(Exp_Basic):
             mses = []
             maes = []
             with torch.no_grad():
-                for i, (batch_x, pred_x, var_mask) in enumerate(test_loader):
-                    pred, true = self._process_one_batch(batch_x, pred_x, var_mask)
+                for i, (batch_x, pred_x, var_period) in enumerate(test_loader):
+                    pred, true = self._process_one_batch(batch_x, pred_x, var_period)
                     pred = pred.detach().cpu().numpy()
                     true = true.detach().cpu().numpy()
                     mae = np.mean(abs(pred - true))
@@ -243,11 +324,11 @@ class Exp_Model(Exp_Basic):
                 os.removedirs(dir_path)
         return mse, mae
 
-    def _process_one_batch(self, batch_x, pred_x, var_mask):
-        batch_x = batch_x.float().to(self.device)
+    def _process_one_batch(self, batch_x, pred_x, var_period):
+        batch_x = batch_x.float().to(self.device, non_blocking=True)
         input_seq = batch_x[:, :self.args.input_len, :]
         batch_y = batch_x[:, -self.args.pred_len:, :]
-        pred_x = pred_x.float().to(self.device)
-        var_mask = var_mask.bool().to(self.device)
-        pred_data = self.model(input_seq, pred_x, var_mask)
+        pred_x = pred_x.float().to(self.device, non_blocking=True)
+        var_period = var_period.to(self.device, non_blocking=True)
+        pred_data = self.model(input_seq, pred_x, var_period)
         return pred_data, batch_y
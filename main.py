@@ -3,8 +3,11 @@ import os
 import torch
 import numpy as np
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from exp.exp_model import Exp_Model
+from exp.exp_model import Exp_Model, Get_Dataset
+from data.table import Read_Table
 
 parser = argparse.ArgumentParser(description='FPPformerV2')
 
@@ -14,7 +17,11 @@ parser.add_argument('--data_path', type=str, default='ETTh1.csv', help='data fil
 parser.add_argument('--features', type=str, default='M',
                     help='forecasting task, options:[M, S]; M:multivariate predict multivariate, '
                          'S: univariate predict univariate')
-parser.add_argument('--target', type=str, default='None', help='target feature in S or M task')
+parser.add_argument('--target', type=str, default='None', help='target feature in S or M task, a comma-separated '
+                                                               'list or all trains several targets in S task')
+parser.add_argument('--target_jobs', type=int, default=1,
+                    help='number of processes training different targets at the same time in S task, each '
+                         'with its share of the CPU threads and its own --num_workers data loader workers')
 parser.add_argument('--ori_target', type=str, default='None', help='Default target, determine the EMD'
                                                                    'result order')
 parser.add_argument('--checkpoints', type=str, default='./checkpoints/', help='location of model checkpoints')
@@ -31,12 +38,64 @@ parser.add_argument('--patch_size', type=int, default=6,
 parser.add_argument('--Cross', action='store_true',
                     help='whether to use cross-variable attention'
                     , default=False)
+parser.add_argument('--attn', type=str, default='einsum',
+                    help='attention backend, options:[einsum, sdpa]; einsum: explicit scores, '
+                         'sdpa: fused torch scaled_dot_product_attention')
+parser.add_argument('--compile', action='store_true',
+                    help='whether to run the model forward through torch.compile'
+                    , default=False)
 parser.add_argument('--EMD', action='store_true',
                     help='whether to use EMD as the prediction initialization'
                     , default=False)
+parser.add_argument('--emd_workers', type=int, default=0,
+                    help='number of processes for the EMD precomputation, 0 means all CPU cores')
+parser.add_argument('--emd_chunk', type=int, default=256,
+                    help='number of windows per saved EMD chunk, interrupted precomputation resumes per chunk')
+parser.add_argument('--emd_mode', type=str, default='emd',
+                    help='period detector of the EMD initialization, options:[emd, fft]; emd: EMD sifting, '
+                         'fft: peaks of the amplitude spectrum, much faster')
+parser.add_argument('--emd_dtype', type=str, default='float64',
+                    help='dtype of the normalized series the EMD is fitted on, options:[float64, float32]; '
+                         'the data are otherwise kept in float32')
+parser.add_argument('--emd_pred_mmap', action='store_true',
+                    help='whether to save the EMD initial forecasts with the EMD cache and memory-map them'
+                    , default=False)
+parser.add_argument('--emd_append', action='store_true',
+                    help='whether to keep one EMD cache per dataset and only compute the windows of newly '
+                         'appended rows'
+                    , default=False)
+parser.add_argument('--emd_lazy', action='store_true',
+                    help='whether to compute the EMD of each window when it is first requested instead of '
+                         'precomputing all windows before training'
+                    , default=False)
+parser.add_argument('--emd_lru', type=int, default=4096,
+                    help='number of windows kept in the LRU of each data loader worker with --emd_lazy')
+parser.add_argument('--emd_lazy_persist', action='store_true',
+                    help='whether to also save the lazily computed EMD windows to disk for later epochs and runs'
+                    , default=False)
 
 parser.add_argument('--dropout', type=float, default=0.05, help='dropout')
 parser.add_argument('--num_workers', type=int, default=0, help='data loader num workers')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='number of batches prepared ahead on a background thread, 0 disables prefetching')
+parser.add_argument('--batch_windows', action='store_true',
+                    help='whether to gather the windows of a whole batch at once instead of one by one'
+                    , default=False)
+parser.add_argument('--device_data', action='store_true',
+                    help='whether to keep each split on the compute device and gather the batches there '
+                         'instead of using the data loader'
+                    , default=False)
+parser.add_argument('--train_stride', type=int, default=1,
+                    help='stride between the training windows of an epoch, drawn from a random offset every epoch')
+parser.add_argument('--epoch_windows', type=int, default=0,
+                    help='number of training windows randomly drawn for every epoch, 0 means all of them')
+parser.add_argument('--stream', action='store_true',
+                    help='whether to stream the windows in chunks from the binary table of the data instead of '
+                         'loading it into memory'
+                    , default=False)
+parser.add_argument('--stream_chunk', type=int, default=4096, help='number of windows per streamed chunk')
+parser.add_argument('--stream_buffer', type=int, default=8192,
+                    help='number of windows in the shuffle buffer of the streamed train split')
 parser.add_argument('--itr', type=int, default=5, help='experiments times')
 parser.add_argument('--train_epochs', type=int, default=20, help='train epochs')
 parser.add_argument('--batch_size', type=int, default=16, help='batch size of train input data')
@@ -96,99 +155,140 @@ if args.data in data_parser.keys():
 
 args.target = args.target.replace('/r', '').replace('/t', '').replace('/n', '')
 
+# --target accepts a comma-separated list of targets (or all) in the S task, trained one after another in this
+# process so that the loaded data and EMD store are shared, or by --target_jobs forked processes
+if args.features == 'S' and args.target == 'all':
+    targets = Read_Table(args.root_path, args.data_path, args.ori_target)[0]
+else:
+    targets = args.target.split(',')
+
 lr = args.learning_rate
 print('Args in experiment:')
 print(args)
 
-mse_total = []
-mae_total = []
-
-Exp = Exp_Model
-for ii in range(args.itr):
-    if args.train:
-        setting = '{}_ft{}_ll{}_pl{}_{}'.format(args.data,
-                                                args.features, args.input_len,
-                                                args.pred_len, ii)
-        print('>>>>>>>start training| pred_len:{}, settings: {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.
-              format(args.pred_len, setting))
-        try:
+
+def init_target_job(num_threads):
+    # run once by each --target_jobs process, whatever the number of targets it trains
+    torch.set_num_threads(num_threads)
+
+
+def run_target(target):
+    args.target = target
+    # models of different targets are saved to different checkpoints
+    data_name = args.data if len(targets) == 1 else '{}_{}'.format(args.data, target)
+    mse_total = []
+    mae_total = []
+
+    Exp = Exp_Model
+    for ii in range(args.itr):
+        if args.train:
+            setting = '{}_ft{}_ll{}_pl{}_{}'.format(data_name,
+                                                    args.features, args.input_len,
+                                                    args.pred_len, ii)
+            print('>>>>>>>start training| pred_len:{}, settings: {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.
+                  format(args.pred_len, setting))
+            try:
+                exp = Exp(args)  # set experiments
+                exp.train(setting)
+            except KeyboardInterrupt:
+                print('-' * 99)
+                print('Exiting from forecasting early')
+
+            print('>>>>>>>testing| pred_len:{}: {}<<<<<<<<<<<<<<<<<'.format(args.pred_len, setting))
+            exp = Exp(args)  # set experiments
+            mse, mae = exp.test(setting, load=True, write_loss=True, save_loss=args.save_loss)
+            mse_total.append(mse)
+            mae_total.append(mae)
+            torch.cuda.empty_cache()
+            args.learning_rate = lr
+        else:
+            setting = '{}_ft{}_ll{}_pl{}_{}'.format(data_name,
+                                                    args.features, args.input_len,
+                                                    args.pred_len, ii)
+            print('>>>>>>>testing| pred_len:{} : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(args.pred_len, setting))
             exp = Exp(args)  # set experiments
-            exp.train(setting)
-        except KeyboardInterrupt:
-            print('-' * 99)
-            print('Exiting from forecasting early')
-
-        print('>>>>>>>testing| pred_len:{}: {}<<<<<<<<<<<<<<<<<'.format(args.pred_len, setting))
-        exp = Exp(args)  # set experiments
-        mse, mae = exp.test(setting, load=True, write_loss=True, save_loss=args.save_loss)
-        mse_total.append(mse)
-        mae_total.append(mae)
-        torch.cuda.empty_cache()
-        args.learning_rate = lr
+
+            mse, mae = exp.test(setting, load=True, write_loss=True, save_loss=args.save_loss)
+            mse_total.append(mse)
+            mae_total.append(mae)
+            torch.cuda.empty_cache()
+            args.learning_rate = lr
+    return target, mse_total, mae_total
+
+
+def write_result(target, mse_total, mae_total):
+    args.target = target
+    if args.features == 'M':
+        path1 = './result.csv'
+        if not os.path.exists(path1):
+            with open(path1, "a") as f:
+                write_csv = ['Time', 'Data', 'input_len', 'pred_len', 'encoder_layer', 'patch_size',
+                             'Min(Mean) MSE', 'Min(Mean) MAE', 'Std MSE', 'Std MAE']
+                np.savetxt(f, np.array(write_csv).reshape(1, -1), fmt='%s', delimiter=',')
+                f.flush()
+                f.close()
     else:
-        setting = '{}_ft{}_ll{}_pl{}_{}'.format(args.data,
-                                                args.features, args.input_len,
-                                                args.pred_len, ii)
-        print('>>>>>>>testing| pred_len:{} : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(args.pred_len, setting))
-        exp = Exp(args)  # set experiments
-
-        mse, mae = exp.test(setting, load=True, write_loss=True, save_loss=args.save_loss)
-        mse_total.append(mse)
-        mae_total.append(mae)
-        torch.cuda.empty_cache()
-        args.learning_rate = lr
-
-if args.features == 'M':
-    path1 = './result.csv'
-    if not os.path.exists(path1):
+        path1 = './result_uni.csv'
+        if not os.path.exists(path1):
+            with open(path1, "a") as f:
+                write_csv = ['Time', 'Data', 'Target', 'input_len', 'pred_len', 'encoder_layer', 'patch_size',
+                             'Min(Mean) MSE', 'Min(Mean) MAE', 'Std MSE', 'Std MAE']
+                np.savetxt(f, np.array(write_csv).reshape(1, -1), fmt='%s', delimiter=',')
+                f.flush()
+                f.close()
+
+    mse = np.asarray(mse_total)
+    mae = np.asarray(mae_total)
+    # avg_mse = np.mean(mse)  # Experiment
+    avg_mse = np.min(mse)  # Practice
+    std_mse = np.std(mse)
+    # avg_mae = np.mean(mae)
+    avg_mae = np.min(mae)
+    std_mae = np.std(mae)
+
+    print('|Min(Mean)|mse:{}, mae:{}|Std|mse:{}, mae:{}'.format(avg_mse, avg_mae, std_mse, std_mae))
+    path = './result.log'
+    with open(path, "a") as f:
+        f.write('|{}_{}|pred_len{}: '.format(
+            args.data, args.features, args.pred_len) + '\n')
+        f.write('|Min(Mean)|mse:{}, mae:{}|Std|mse:{}, mae:{}'.
+                format(avg_mse, avg_mae, std_mse, std_mae) + '\n')
+        f.flush()
+        f.close()
+
+    if args.features == 'M':
         with open(path1, "a") as f:
-            write_csv = ['Time', 'Data', 'input_len', 'pred_len', 'encoder_layer', 'patch_size', 'Min(Mean) MSE',
-                         'Min(Mean) MAE', 'Std MSE', 'Std MAE']
-            np.savetxt(f, np.array(write_csv).reshape(1, -1), fmt='%s', delimiter=',')
+            f.write(time.strftime("%Y-%m-%d-%H_%M_%S", time.localtime()))
+            f.write(',{},{},{},{},{},{},{},{},{}'.
+                    format(args.data, args.input_len, args.pred_len, args.encoder_layer,
+                           args.patch_size, avg_mse, avg_mae, std_mse, std_mae) + '\n')
             f.flush()
             f.close()
-else:
-    path1 = './result_uni.csv'
-    if not os.path.exists(path1):
+    else:
         with open(path1, "a") as f:
-            write_csv = ['Time', 'Data', 'Target', 'input_len', 'pred_len', 'encoder_layer', 'patch_size',
-                         'Min(Mean) MSE', 'Min(Mean) MAE', 'Std MSE', 'Std MAE']
-            np.savetxt(f, np.array(write_csv).reshape(1, -1), fmt='%s', delimiter=',')
+            f.write(time.strftime("%Y-%m-%d-%H_%M_%S", time.localtime()))
+            f.write(',{},{},{},{},{},{},{},{},{},{}'.
+                    format(args.data, args.target, args.input_len, args.pred_len, args.encoder_layer,
+                           args.patch_size, avg_mse, avg_mae, std_mse, std_mae) + '\n')
             f.flush()
             f.close()
+    return avg_mse, avg_mae
 
-mse = np.asarray(mse_total)
-mae = np.asarray(mae_total)
-# avg_mse = np.mean(mse)  # Experiment
-avg_mse = np.min(mse)  # Practice
-std_mse = np.std(mse)
-# avg_mae = np.mean(mae)
-avg_mae = np.min(mae)
-std_mae = np.std(mae)
-
-print('|Min(Mean)|mse:{}, mae:{}|Std|mse:{}, mae:{}'.format(avg_mse, avg_mae, std_mse, std_mae))
-path = './result.log'
-with open(path, "a") as f:
-    f.write('|{}_{}|pred_len{}: '.format(
-        args.data, args.features, args.pred_len) + '\n')
-    f.write('|Min(Mean)|mse:{}, mae:{}|Std|mse:{}, mae:{}'.
-            format(avg_mse, avg_mae, std_mse, std_mae) + '\n')
-    f.flush()
-    f.close()
-
-if args.features == 'M':
-    with open(path1, "a") as f:
-        f.write(time.strftime("%Y-%m-%d-%H_%M_%S", time.localtime()))
-        f.write(',{},{},{},{},{},{},{},{},{}'.
-                format(args.data, args.input_len, args.pred_len, args.encoder_layer,
-                       args.patch_size, avg_mse, avg_mae, std_mse, std_mae) + '\n')
-        f.flush()
-        f.close()
+
+if args.target_jobs > 1 and len(targets) > 1:
+    # the data and EMD store are loaded once here and inherited by the forked workers, each training a share of
+    # the targets; the results are written here as they finish
+    args.target = targets[0]
+    for flag in ['train', 'val', 'test']:
+        Get_Dataset(args, flag)
+    # the executor processes are not daemonic, so that they can start their own DataLoader workers
+    num_threads = max(1, torch.get_num_threads() // args.target_jobs)
+    with ProcessPoolExecutor(args.target_jobs, mp_context=multiprocessing.get_context('fork'),
+                             initializer=init_target_job, initargs=(num_threads,)) as pool:
+        jobs = [pool.submit(run_target, target) for target in targets]
+        results = [write_result(*job.result()) for job in as_completed(jobs)]
 else:
-    with open(path1, "a") as f:
-        f.write(time.strftime("%Y-%m-%d-%H_%M_%S", time.localtime()))
-        f.write(',{},{},{},{},{},{},{},{},{},{}'.
-                format(args.data, args.target, args.input_len, args.pred_len, args.encoder_layer,
-                       args.patch_size, avg_mse, avg_mae, std_mse, std_mae) + '\n')
-        f.flush()
-        f.close()
\ No newline at end of file
+    results = [write_result(*run_target(target)) for target in targets]
+
+if len(targets) > 1:
+    print('|{} targets|mean Min(Mean)|mse:{}, mae:{}'.format(len(targets), *np.mean(results, axis=0)))
@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FPPformer2.Modules import Attn_PointLevel, Attn_PatchLevel, Attn_VarLevel
+
+# Accuracy/speed report of the --attn backends per attention module: the sdpa module gets the weights of the
+# einsum one, the outputs and input gradients of both are compared (dropout off), and forward and
+# forward + backward are timed, with the shapes of the first encoder layer of an ECL-like configuration.
+# python -u scripts/benchmark_attention.py --vars 321 --steps 10
+
+parser = argparse.ArgumentParser(description='einsum vs sdpa attention')
+parser.add_argument('--vars', type=int, default=321, help='number of variables')
+parser.add_argument('--batch_size', type=int, default=16, help='batch size')
+parser.add_argument('--input_len', type=int, default=96, help='input length')
+parser.add_argument('--patch_size', type=int, default=6, help='patch size')
+parser.add_argument('--d_model', type=int, default=28, help='hidden dims of model')
+parser.add_argument('--steps', type=int, default=10, help='number of timed steps')
+args = parser.parse_args()
+
+B, V, L, D = args.batch_size, args.vars, args.patch_size, args.d_model
+P = args.input_len // args.patch_size
+torch.manual_seed(0)
+var_period = torch.randint(0, 3, [B, V])
+var_mask = var_period.unsqueeze(-1) != var_period.unsqueeze(-2)  # [B V V]
+
+cases = [
+    ('PointLevel', 'Diag', Attn_PointLevel, D, [B, V, P, L, D], {'mask': 'Diag'}),
+    ('PointLevel', 'Causal', Attn_PointLevel, D, [B, V, P, L, D], {'mask': 'Causal'}),
+    ('PointLevel', 'None', Attn_PointLevel, D, [B, V, P, L, D], {'mask': None}),
+    ('PatchLevel', 'Diag', Attn_PatchLevel, L * D, [B, V, P, L * D], {'mask': 'Diag'}),
+    ('PatchLevel', 'None', Attn_PatchLevel, L * D, [B, V, P, L * D], {'mask': None}),
+    ('VarLevel', 'var_mask', Attn_VarLevel, L * D, [B, P, V, L * D], {'var_mask': var_mask}),
+]
+
+
+def timed(module, x, kwargs, backward):
+    def step():
+        x.grad = None
+        out = module(x, x, x, **kwargs)
+        if backward:
+            out.sum().backward()
+    step()
+    time_now = time.time()
+    for _ in range(args.steps):
+        if backward:
+            step()
+        else:
+            with torch.no_grad():
+                step()
+    return (time.time() - time_now) / args.steps * 1e3
+
+
+print('|Module|Mask|Max out diff|Max grad diff|einsum fwd (ms)|sdpa fwd (ms)|einsum fwd+bwd (ms)|sdpa fwd+bwd (ms)|')
+for name, mask, Attn, d_model, shape, kwargs in cases:
+    einsum_attn = Attn(d_model, 0., 'einsum')
+    sdpa_attn = Attn(d_model, 0., 'sdpa')
+    sdpa_attn.load_state_dict(einsum_attn.state_dict())
+    x = torch.randn(shape, requires_grad=True)
+
+    outs, grads = [], []
+    for module in [einsum_attn, sdpa_attn]:
+        x.grad = None
+        out = module(x, x, x, **kwargs)
+        out.sum().backward()
+        outs.append(out.detach())
+        grads.append(x.grad.clone())
+    out_diff = (outs[0] - outs[1]).abs().max().item()
+    grad_diff = (grads[0] - grads[1]).abs().max().item()
+
+    times = [timed(module, x, kwargs, backward) for backward in [False, True] for module in [einsum_attn, sdpa_attn]]
+    print('|{}|{}|{:.2e}|{:.2e}|{:.1f}|{:.1f}|{:.1f}|{:.1f}|'.format(name, mask, out_diff, grad_diff, *times))
@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FPPformer2.FPPformer import FPPformer
+from FPPformer2.FPPformer_Cross import FPPformer_Cross
+
+# Latency/throughput report of --compile: inference of FPPformer_Cross (FPPformer without --Cross) with the
+# ETTh1 and ECL configurations of scripts/Main.sh, eager and through torch.compile(fullgraph=True), on random
+# inputs for several batch sizes. The compile time (first batch of each size) is reported separately.
+# python -u scripts/benchmark_compile.py --data ETTh1 ECL --batch_sizes 1 8 32 --steps 20
+
+parser = argparse.ArgumentParser(description='eager vs compiled inference')
+parser.add_argument('--data', type=str, nargs='+', default=['ETTh1', 'ECL'], help='configurations to report')
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='batch sizes to report')
+parser.add_argument('--pred_len', type=int, default=192, help='prediction length')
+parser.add_argument('--steps', type=int, default=20, help='number of timed batches')
+parser.add_argument('--Cross', action='store_true', help='whether to use cross-variable attention', default=False)
+parser.add_argument('--attn', type=str, default='einsum', help='attention backend, options:[einsum, sdpa]')
+args = parser.parse_args()
+
+data_parser = {
+    'ETTh1': {'vars': 7, 'input_len': 96, 'encoder_layer': 3, 'patch_size': 6, 'd_model': 32},
+    'ECL': {'vars': 321, 'input_len': 96, 'encoder_layer': 3, 'patch_size': 6, 'd_model': 32},
+}
+Model = FPPformer_Cross if args.Cross else FPPformer
+
+
+def timed(model, inputs):
+    with torch.no_grad():
+        time_now = time.time()
+        model(*inputs)
+        first_time = time.time() - time_now
+        time_now = time.time()
+        for _ in range(args.steps):
+            model(*inputs)
+    return first_time, (time.time() - time_now) / args.steps
+
+
+print('|Data|Batch size|Eager (ms)|Compiled (ms)|Speedup|Eager windows/s|Compiled windows/s|Compile time (s)|')
+for name in args.data:
+    info = data_parser[name]
+    model = Model(info['input_len'], args.pred_len, info['encoder_layer'], info['patch_size'], info['d_model'], 0.1,
+                  args.attn).float().eval()
+    compiled = torch.compile(model, fullgraph=True)
+    for batch_size in args.batch_sizes:
+        inputs = (torch.randn(batch_size, info['input_len'], info['vars']),
+                  torch.randn(batch_size, args.pred_len, info['vars']),
+                  torch.randint(0, 3, [batch_size, info['vars']], dtype=torch.int16))
+        _, eager_time = timed(model, inputs)
+        compile_time, compiled_time = timed(compiled, inputs)
+        print('|{}|{}|{:.2f}|{:.2f}|{:.2f}x|{:.0f}|{:.0f}|{:.1f}|'.format(
+            name, batch_size, eager_time * 1e3, compiled_time * 1e3, eager_time / compiled_time,
+            batch_size / eager_time, batch_size / compiled_time, compile_time))
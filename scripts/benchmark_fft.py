@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.data_loader import Dataset_Custom
+from utils.EMD import EMD_Find_Freq, FFT_Find_Freq, EMD_Reconstruct_Batch, EMD_Waves
+
+warnings.filterwarnings('ignore')
+
+# Accuracy report of the period detectors of --emd_mode: on windows of the test split, the EMD initial
+# forecasts built from the EMD-sifted periods and from the FFT peaks are compared with the ground truth
+# (and with the mean initialization used without --EMD), together with the time spent detecting periods.
+# python -u scripts/benchmark_fft.py --windows 200
+
+parser = argparse.ArgumentParser(description='FFT vs EMD period detection')
+parser.add_argument('--data', type=str, nargs='+', default=['Air', 'River', 'BTC'], help='datasets to report')
+parser.add_argument('--input_len', type=int, default=96, help='input length')
+parser.add_argument('--pred_len', type=int, default=96, help='prediction length')
+parser.add_argument('--windows', type=int, default=200, help='number of test windows per dataset')
+args = parser.parse_args()
+
+data_parser = {
+    'Air': {'data': 'Air.csv', 'target': 'AH', 'root_path': './data/Air/'},
+    'River': {'data': 'River.csv', 'target': 'DLDI4__0', 'root_path': './data/River/'},
+    'BTC': {'data': 'BTC.csv', 'target': 'Volume USD', 'root_path': './data/BTC/'},
+}
+
+L, P = args.input_len, args.pred_len
+sin_waves, cos_waves = EMD_Waves(L, P)
+
+
+def forecast(windows, local_freqs):
+    coefs = EMD_Reconstruct_Batch(windows, local_freqs, L, sin_waves, cos_waves)
+    preds = []
+    for coef, local_freq in zip(coefs, local_freqs):
+        local_freq = local_freq.astype(np.int64)
+        basis = np.concatenate([np.ones([1, L + P]), sin_waves[local_freq], cos_waves[local_freq]], axis=0)
+        preds.append(coef @ basis[:, L:])
+    return np.array(preds)
+
+
+print('|Data|Mode|Detect time (s)|Windows/s|MSE|MAE|Same dominant period|')
+for name in args.data:
+    info = data_parser[name]
+    data_set = Dataset_Custom(root_path=info['root_path'], data_path=info['data'], flag='test', size=[L, P],
+                              features='M', target=info['target'], ori_target=info['target'], EMD=False)
+    starts = np.linspace(0, len(data_set) - 1, args.windows).astype(int)
+    seq = np.stack([data_set.data_x[i: i + L + P] for i in starts]).transpose(0, 2, 1).reshape(-1, L + P)
+    windows, trues = seq[:, :L], seq[:, L:]
+
+    time_now = time.time()
+    emd_freqs, emd_sfreq = [], []
+    for window in windows:
+        local_freq, s_freq = EMD_Find_Freq(window, L)
+        emd_freqs.append(local_freq)
+        emd_sfreq.append(s_freq)
+    emd_time = time.time() - time_now
+
+    time_now = time.time()
+    fft_freqs, fft_sfreq = FFT_Find_Freq(windows, L)
+    fft_time = time.time() - time_now
+
+    mean_pred = windows.mean(axis=1, keepdims=True).repeat(P, axis=1)
+    same = np.mean(np.array(emd_sfreq) == fft_sfreq)
+    for mode, preds, cost in [('emd', forecast(windows, emd_freqs), emd_time),
+                              ('fft', forecast(windows, fft_freqs), fft_time),
+                              ('mean', mean_pred, 0.)]:
+        print('|{}|{}|{:.3f}|{}|{:.4f}|{:.4f}|{}|'.format(
+            name, mode, cost, '{:.0f}'.format(len(windows) / cost) if cost > 0 else '-',
+            np.mean((preds - trues) ** 2), np.mean(np.abs(preds - trues)),
+            '{:.1%}'.format(same) if mode == 'fft' else '-'))
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.data_loader import Dataset_Custom, Dataset_Batch
+
+warnings.filterwarnings('ignore')
+
+# Memory/throughput report of the float32 data pipeline: the series of the train split is kept in float32
+# (as the Dataset_* classes do) or cast back to float64 (as they did before), then batches are drawn through the
+# DataLoader and cast to float32 on the way to the model, as in Exp_Model._process_one_batch.
+# python -u scripts/benchmark_float32.py --data ECL Traffic --batches 200
+
+parser = argparse.ArgumentParser(description='float32 vs float64 data pipeline')
+parser.add_argument('--data', type=str, nargs='+', default=['ECL', 'Traffic'], help='datasets to report')
+parser.add_argument('--input_len', type=int, default=96, help='input length')
+parser.add_argument('--pred_len', type=int, default=96, help='prediction length')
+parser.add_argument('--batch_size', type=int, default=16, help='batch size')
+parser.add_argument('--batches', type=int, default=200, help='number of batches to draw')
+parser.add_argument('--batch_windows', action='store_true', help='gather whole batches with Dataset_Batch',
+                    default=False)
+args = parser.parse_args()
+
+data_parser = {
+    'ECL': {'data': 'ECL.csv', 'target': 'MT_321', 'root_path': './data/ECL/'},
+    'Traffic': {'data': 'Traffic.csv', 'target': 'Sensor_861', 'root_path': './data/Traffic/'},
+    'Solar': {'data': 'solar_AL.csv', 'target': '136', 'root_path': './data/Solar/'},
+    'Air': {'data': 'Air.csv', 'target': 'AH', 'root_path': './data/Air/'},
+    'River': {'data': 'River.csv', 'target': 'DLDI4__0', 'root_path': './data/River/'},
+    'BTC': {'data': 'BTC.csv', 'target': 'Volume USD', 'root_path': './data/BTC/'},
+}
+
+
+def throughput(data_set):
+    if args.batch_windows:
+        data_loader = DataLoader(Dataset_Batch(data_set), batch_size=None,
+                                 sampler=BatchSampler(RandomSampler(data_set), args.batch_size, True))
+    else:
+        data_loader = DataLoader(data_set, batch_size=args.batch_size, shuffle=True, drop_last=True)
+    time_now = time.time()
+    count = 0
+    for i, (batch_x, pred_x, var_period) in enumerate(data_loader):
+        batch_x = batch_x.float()
+        pred_x = pred_x.float()
+        count += batch_x.shape[0]
+        if i + 1 == args.batches:
+            break
+    return count / (time.time() - time_now)
+
+
+print('|Data|dtype|Series (MB)|Batch bytes (KB)|Windows/s|')
+for name in args.data:
+    info = data_parser[name]
+    data_set = Dataset_Custom(root_path=info['root_path'], data_path=info['data'], flag='train',
+                              size=[args.input_len, args.pred_len], features='M', target=info['target'],
+                              ori_target=info['target'], EMD=False)
+    data_x = data_set.data_x
+    for dtype in [np.float32, np.float64]:
+        data_set.data_x = np.asarray(data_x, dtype=dtype)
+        batch_bytes = args.batch_size * (args.input_len + args.pred_len) * data_x.shape[1] * np.dtype(dtype).itemsize
+        speed = max(throughput(data_set) for _ in range(3))
+        print('|{}|{}|{:.1f}|{:.1f}|{:.0f}|'.format(name, np.dtype(dtype).name, data_set.data_x.nbytes / 2 ** 20,
+                                                     batch_bytes / 2 ** 10, speed))
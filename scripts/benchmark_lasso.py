@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.EMD import EMD_Find_Freq, EMD_Reconstruct, EMD_Reconstruct_Batch, LASSO_ALPHA
+
+warnings.filterwarnings('ignore')
+
+# Compares the per-window sklearn Lasso of EMD_Reconstruct with the batched coordinate descent of
+# EMD_Reconstruct_Batch on real windows: coefficients, Lasso objective and fitting time.
+# python -u scripts/benchmark_lasso.py --root_path ./data/River/ --data_path River.csv --windows 300
+
+parser = argparse.ArgumentParser(description='Batched Lasso benchmark')
+parser.add_argument('--root_path', type=str, default='./data/River/', help='root path of the data file')
+parser.add_argument('--data_path', type=str, default='River.csv', help='data file')
+parser.add_argument('--input_len', type=int, default=96, help='input length')
+parser.add_argument('--windows', type=int, default=300, help='number of windows (of all variables) to fit')
+parser.add_argument('--atol', type=float, default=5e-3, help='allowed absolute coefficient difference')
+args = parser.parse_args()
+
+df_raw = pd.read_csv(os.path.join(args.root_path, args.data_path))
+data = df_raw[df_raw.columns[1:]].values.astype(np.float64)
+data = (data - data.mean(0)) / (data.std(0) + 1e-8)
+
+L = args.input_len
+sin_waves = np.zeros([L + 1, L])
+cos_waves = np.zeros([L + 1, L])
+for i in range(1, L + 1):
+    sin_waves[i] = np.sin((2 * np.pi * i / L) * np.arange(L))
+    cos_waves[i] = np.cos((2 * np.pi * i / L) * np.arange(L))
+
+starts = np.linspace(0, len(data) - L - 1, args.windows).astype(int)
+windows = []
+local_freqs = []
+print('Finding EMD-based freqs of {} windows x {} variables'.format(len(starts), data.shape[1]))
+for i in starts:
+    for j in range(data.shape[1]):
+        local_freq, _ = EMD_Find_Freq(data[i: i + L, j], L)
+        windows.append(data[i: i + L, j])
+        local_freqs.append(local_freq.astype(np.int64))
+windows = np.array(windows)
+
+time_now = time.time()
+sk_coefs = []
+for window, local_freq in zip(windows, local_freqs):
+    if local_freq.shape[0] > 0:
+        input_features = np.concatenate([sin_waves[local_freq], cos_waves[local_freq]], axis=0)
+    else:
+        input_features = None
+    sk_coefs.append(EMD_Reconstruct(window, L, input_features))
+sk_time = time.time() - time_now
+
+time_now = time.time()
+cd_coefs = EMD_Reconstruct_Batch(windows, local_freqs, L, sin_waves, cos_waves)
+cd_time = time.time() - time_now
+
+
+def objective(coef, window, local_freq):
+    features = np.concatenate([np.ones([1, L]), sin_waves[local_freq], cos_waves[local_freq]], axis=0)
+    return np.sum((window - coef @ features) ** 2) / (2 * L) + LASSO_ALPHA * np.sum(np.abs(coef))
+
+
+coef_diff = max(np.max(np.abs(a - b)) for a, b in zip(sk_coefs, cd_coefs))
+obj_diff = np.array([objective(b, w, f) - objective(a, w, f)
+                     for a, b, w, f in zip(sk_coefs, cd_coefs, windows, local_freqs)])
+print('problems: {} | sklearn: {:.3f}s | batched: {:.3f}s | speedup: {:.1f}x'.
+      format(len(windows), sk_time, cd_time, sk_time / cd_time))
+print('max |coef diff|: {:.2e} | objective (batched - sklearn): max {:.2e}, mean {:.2e}'.
+      format(coef_diff, obj_diff.max(), obj_diff.mean()))
+assert coef_diff < args.atol, 'batched Lasso deviates from sklearn'
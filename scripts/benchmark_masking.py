@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import FPPformer2.Modules as Modules
+from FPPformer2.FPPformer import FPPformer
+from utils.masking import Mask_Stats, Mask_Cache_Clear
+
+# Allocation report of the attention masks: the cached broadcast masks of utils/masking.py against the masks
+# materialized to the full [B V P L L] / [B V P P] shape at every call (as they were built before), over forwards
+# of FPPformer with ECL/Traffic-like sizes.
+# python -u scripts/benchmark_masking.py --vars 321 862 --steps 5
+
+parser = argparse.ArgumentParser(description='cached vs materialized attention masks')
+parser.add_argument('--vars', type=int, nargs='+', default=[321, 862], help='numbers of variables to report')
+parser.add_argument('--batch_size', type=int, default=16, help='batch size')
+parser.add_argument('--input_len', type=int, default=96, help='input length')
+parser.add_argument('--pred_len', type=int, default=96, help='prediction length')
+parser.add_argument('--steps', type=int, default=5, help='number of timed forwards')
+parser.add_argument('--use_gpu', action='store_true', help='whether to run on the gpu', default=False)
+args = parser.parse_args()
+
+device = torch.device('cuda:0' if args.use_gpu and torch.cuda.is_available() else 'cpu')
+materialized = {'allocations': 0, 'bytes': 0}
+
+
+def count(mask):
+    materialized['allocations'] += 1
+    materialized['bytes'] += mask.element_size() * mask.nelement()
+    return mask
+
+
+class OffDiagMask_PointLevel():
+    def __init__(self, B, V, P, L, device="cpu"):
+        with torch.no_grad():
+            _mask = torch.eye(L, L, dtype=torch.bool).to(device)
+            self.mask = count(_mask.unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(B, V, P, 1, 1))
+
+
+class OffDiagMask_PatchLevel():
+    def __init__(self, B, V, P, device="cpu"):
+        with torch.no_grad():
+            _mask = torch.eye(P, P, dtype=torch.bool).to(device)
+            self.mask = count(_mask.unsqueeze(0).unsqueeze(0).repeat(B, V, 1, 1))
+
+
+cached = (Modules.OffDiagMask_PointLevel, Modules.OffDiagMask_PatchLevel)
+
+
+def run(model, x, y, var_period):
+    with torch.no_grad():
+        model(x, y, var_period)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        time_now = time.time()
+        for _ in range(args.steps):
+            model(x, y, var_period)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - time_now) / args.steps
+
+
+print('|Vars|Masks|Mask allocations ({} forwards)|Mask MB allocated|Forward (ms)|'.format(args.steps + 1))
+for V in args.vars:
+    model = FPPformer(args.input_len, args.pred_len).float().to(device).eval()
+    x = torch.randn(args.batch_size, args.input_len, V, device=device)
+    y = torch.randn(args.batch_size, args.pred_len, V, device=device)
+    var_period = torch.zeros(args.batch_size, V, dtype=torch.int16, device=device)
+
+    Modules.OffDiagMask_PointLevel, Modules.OffDiagMask_PatchLevel = OffDiagMask_PointLevel, OffDiagMask_PatchLevel
+    forward_time = run(model, x, y, var_period)
+    print('|{}|materialized|{}|{:.2f}|{:.1f}|'.format(V, materialized['allocations'], materialized['bytes'] / 2 ** 20,
+                                                   forward_time * 1e3))
+    materialized.update(allocations=0, bytes=0)
+
+    Modules.OffDiagMask_PointLevel, Modules.OffDiagMask_PatchLevel = cached
+    Mask_Cache_Clear()
+    forward_time = run(model, x, y, var_period)
+    stats = Mask_Stats()
+    print('|{}|cached|{}|{:.4f}|{:.1f}|'.format(V, stats['allocations'], stats['bytes'] / 2 ** 20, forward_time * 1e3))
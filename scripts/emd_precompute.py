@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import warnings
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.data_loader import Dataset_ETT_hour, Dataset_ETT_min, Dataset_Custom
+
+warnings.filterwarnings('ignore')
+
+# Standalone EMD precomputation of a dataset, split over several machines sharing ./EMD/ (e.g. an NFS mount).
+# The EMD cache covers the windows of all splits; each shard job computes every num_shards-th chunk of them into
+# the chunk folder of the cache, then merge checks that all chunks are there and assembles the cache the
+# Dataset_* classes load (same key as main.py with the same --input_len, --emd_mode and --emd_dtype).
+# python -u scripts/emd_precompute.py shard --data Traffic --shard 0 --num-shards 4   (one per machine, 0..3)
+# python -u scripts/emd_precompute.py merge --data Traffic
+
+common = argparse.ArgumentParser(add_help=False)
+common.add_argument('--data', type=str, required=True, help='dataset')
+common.add_argument('--input_len', type=int, default=96, help='input length')
+common.add_argument('--emd_mode', type=str, default='emd', help='period detector, options:[emd, fft]')
+common.add_argument('--emd_dtype', type=str, default='float64',
+                    help='dtype of the normalized series the EMD is fitted on, options:[float64, float32]')
+
+parser = argparse.ArgumentParser(description='Sharded EMD precomputation')
+subparsers = parser.add_subparsers(dest='command', required=True)
+shard_parser = subparsers.add_parser('shard', parents=[common], help='compute one shard of the EMD cache')
+shard_parser.add_argument('--shard', type=int, required=True, help='index of this shard, from 0')
+shard_parser.add_argument('--num_shards', '--num-shards', type=int, required=True, help='number of shards')
+shard_parser.add_argument('--emd_workers', type=int, default=0,
+                          help='number of processes of this shard, 0 means all CPU cores')
+shard_parser.add_argument('--emd_chunk', type=int, default=256,
+                          help='number of windows per chunk, the same for all shards')
+subparsers.add_parser('merge', parents=[common], help='check the shards and assemble the EMD cache')
+args = parser.parse_args()
+
+data_parser = {
+    'ETTh1': {'data': 'ETTh1.csv', 'target': 'OT', 'root_path': './data/ETT/', 'Data': Dataset_ETT_hour},
+    'ETTh2': {'data': 'ETTh2.csv', 'target': 'OT', 'root_path': './data/ETT/', 'Data': Dataset_ETT_hour},
+    'ETTm1': {'data': 'ETTm1.csv', 'target': 'OT', 'root_path': './data/ETT/', 'Data': Dataset_ETT_min},
+    'ETTm2': {'data': 'ETTm2.csv', 'target': 'OT', 'root_path': './data/ETT/', 'Data': Dataset_ETT_min},
+    'ECL': {'data': 'ECL.csv', 'target': 'MT_321', 'root_path': './data/ECL/', 'Data': Dataset_Custom},
+    'Traffic': {'data': 'Traffic.csv', 'target': 'Sensor_861', 'root_path': './data/Traffic/', 'Data': Dataset_Custom},
+    'weather': {'data': 'weather.csv', 'target': 'OT', 'root_path': './data/weather/', 'Data': Dataset_Custom},
+    'Solar': {'data': 'solar_AL.csv', 'target': '136', 'root_path': './data/Solar/', 'Data': Dataset_Custom},
+    'Air': {'data': 'Air.csv', 'target': 'AH', 'root_path': './data/Air/', 'Data': Dataset_Custom},
+    'River': {'data': 'River.csv', 'target': 'DLDI4__0', 'root_path': './data/River/', 'Data': Dataset_Custom},
+    'BTC': {'data': 'BTC.csv', 'target': 'Volume USD', 'root_path': './data/BTC/', 'Data': Dataset_Custom},
+    'ETH': {'data': 'ETH.csv', 'target': 'Volume USDT', 'root_path': './data/ETH/', 'Data': Dataset_Custom}
+}
+
+if args.command == 'shard':
+    assert 0 <= args.shard < args.num_shards
+    emd_shard = (args.shard, args.num_shards)
+    emd_workers, emd_chunk = args.emd_workers, args.emd_chunk
+else:
+    emd_shard = 'merge'
+    emd_workers, emd_chunk = 0, 256
+
+info = data_parser[args.data]
+# the train split builds the cache of all splits, the prediction length does not enter it
+data_set = info['Data'](root_path=info['root_path'], data_path=info['data'], flag='train',
+                        size=[args.input_len, 1], features='M', target=info['target'], ori_target=info['target'],
+                        EMD=True, emd_workers=emd_workers, emd_chunk=emd_chunk, emd_mode=args.emd_mode,
+                        emd_dtype=args.emd_dtype, emd_shard=emd_shard)
+if data_set.emd_store is None:
+    print('Shard {} of {} done'.format(args.shard, args.num_shards))
+else:
+    print('EMD cache of {} windows at {}'.format(len(data_set.emd_store), data_set.emd_store.path))
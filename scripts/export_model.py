@@ -0,0 +1,59 @@
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FPPformer2.FPPformer import FPPformer
+from FPPformer2.FPPformer_Cross import FPPformer_Cross
+
+# Export of a trained FPPformer/FPPformer_Cross checkpoint (same model arguments as main.py) with torch.export,
+# as a traced TorchScript module or to ONNX, for a fixed batch size. The exported model is checked against the
+# eager one on random inputs.
+# python -u scripts/export_model.py --checkpoint ./checkpoints/<setting>/checkpoint.pth --enc_in 7 --format onnx
+
+parser = argparse.ArgumentParser(description='Export FPPformer')
+parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint to export, random weights without it')
+parser.add_argument('--format', type=str, default='export', choices=['export', 'torchscript', 'onnx'],
+                    help='export format')
+parser.add_argument('--output', type=str, default='./FPPformer_export', help='output path without extension')
+parser.add_argument('--enc_in', type=int, default=7, help='input variable number')
+parser.add_argument('--batch_size', type=int, default=1, help='batch size of the exported model')
+parser.add_argument('--input_len', type=int, default=96, help='input length')
+parser.add_argument('--pred_len', type=int, default=96, help='prediction length')
+parser.add_argument('--d_model', type=int, default=28, help='hidden dims of model')
+parser.add_argument('--encoder_layer', type=int, default=3)
+parser.add_argument('--patch_size', type=int, default=6, help='the initial patch size in patch-wise attention')
+parser.add_argument('--Cross', action='store_true', help='whether to use cross-variable attention', default=False)
+parser.add_argument('--attn', type=str, default='einsum', help='attention backend, options:[einsum, sdpa]')
+args = parser.parse_args()
+
+Model = FPPformer_Cross if args.Cross else FPPformer
+model = Model(args.input_len, args.pred_len, args.encoder_layer, args.patch_size, args.d_model, 0.,
+              args.attn).float().eval()
+if args.checkpoint is not None:
+    model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+
+inputs = (torch.randn(args.batch_size, args.input_len, args.enc_in),
+          torch.randn(args.batch_size, args.pred_len, args.enc_in),
+          torch.zeros(args.batch_size, args.enc_in, dtype=torch.int16))
+with torch.no_grad():
+    if args.format == 'export':
+        path = args.output + '.pt2'
+        exported = torch.export.export(model, inputs)
+        torch.export.save(exported, path)
+        exported = exported.module()
+    elif args.format == 'torchscript':
+        path = args.output + '.pt'
+        exported = torch.jit.trace(model, inputs)
+        exported.save(path)
+    else:
+        path = args.output + '.onnx'
+        torch.onnx.export(model, inputs, path, input_names=['x', 'y', 'var_period'], output_names=['pred'])
+        exported = None
+
+    if exported is not None:
+        check = (torch.randn_like(inputs[0]), torch.randn_like(inputs[1]), inputs[2])
+        print('max abs diff to eager: {:.2e}'.format((exported(*check) - model(*check)).abs().max().item()))
+print('saved to {}'.format(path))
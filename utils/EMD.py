@@ -1,12 +1,31 @@
+import os
+import time
+import warnings
+import multiprocessing
+
 import PyEMD
 from sklearn.linear_model import Lasso
 from scipy.signal import savgol_filter
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+SAVGOL_WINDOW = 5
+SAVGOL_ORDER = 2
+EMD_STD_THR = 0.01
+EMD_RANGE_THR = 0.05
+EMD_MIN_AMP = 0.2
+LASSO_ALPHA = 0.1  # ETTm, ECL, Traffic, Weather, Solar, Air
+# LASSO_ALPHA = 0.01  # River
+# LASSO_ALPHA = 0.001  # ETTh, BTC, ETH
+LASSO_MAX_ITER = 1000
+LASSO_TOL = 1e-6  # relative weight change that stops the batched coordinate descent
+FFT_MAX_FREQ = 4  # the EMD detector rarely keeps more than four periods per window
+FFT_REL_AMP = 0.3  # spectral peaks below this share of the largest peak are ignored by the FFT detector
 
 
 def find_freqs(emd_x, data_x, start_loc, end_loc):
     current_data = data_x.reshape(-1)
-    current_data = savgol_filter(current_data, 5, 2)
+    current_data = savgol_filter(current_data, SAVGOL_WINDOW, SAVGOL_ORDER)
     current_len = end_loc - start_loc
     C_IMF = emd_x.emd(current_data)
 
@@ -21,7 +40,7 @@ def find_freqs(emd_x, data_x, start_loc, end_loc):
             c_j = 0
             while cmax_freq_group[-(c_j + 1)] <= 1:  # Ignoring too low frequency or trend
                 c_j += 1
-            if A_CF_imf[-(c_j + 1)] < 0.2:  # Ignoring too small amplitude
+            if A_CF_imf[-(c_j + 1)] < EMD_MIN_AMP:  # Ignoring too small amplitude
                 continue
             c_freq_length = cmax_freq_group[-(c_j + 1)]
             if c_freq_length in g_freq:
@@ -38,12 +57,34 @@ def find_freqs(emd_x, data_x, start_loc, end_loc):
 
 
 def EMD_Find_Freq(df_values, seq_length):
-    emd = PyEMD.EMD(std_thr=0.01, range_thr=0.05)
+    emd = PyEMD.EMD(std_thr=EMD_STD_THR, range_thr=EMD_RANGE_THR)
     local_freq, s_freq = find_freqs(emd, df_values, 0, seq_length)
     local_freq = list(set(local_freq))
     return np.array(local_freq), s_freq
 
 
+def FFT_Find_Freq(windows, seq_length):
+    """
+    Fast alternative to EMD_Find_Freq for many windows at once: instead of sifting IMFs, the largest local
+    maxima of the amplitude spectrum of each smoothed window are taken as its periods.
+    :param windows: [N, seq_length]
+    :return: N frequency arrays and the dominant frequency of each window [N]
+    """
+    current_data = savgol_filter(windows, SAVGOL_WINDOW, SAVGOL_ORDER, axis=-1)
+    A_CF = np.abs(np.fft.rfft(current_data, axis=-1))  # [N, seq_length // 2 + 1]
+    A_CF[:, :2] = 0  # Ignoring too low frequency or trend
+    left = np.concatenate([np.zeros([A_CF.shape[0], 1]), A_CF[:, :-1]], axis=1)
+    right = np.concatenate([A_CF[:, 1:], np.zeros([A_CF.shape[0], 1])], axis=1)
+    peaks = np.where((A_CF >= left) & (A_CF >= right) & (A_CF >= EMD_MIN_AMP), A_CF, 0)
+
+    top_freq = np.argsort(-peaks, axis=1)[:, :FFT_MAX_FREQ]
+    top_amp = np.take_along_axis(peaks, top_freq, axis=1)
+    keep = (top_amp > 0) & (top_amp >= FFT_REL_AMP * top_amp[:, :1])
+    local_freqs = [top_freq[i][keep[i]] for i in range(windows.shape[0])]
+    s_freq = np.where(keep[:, 0], top_freq[:, 0], 0)
+    return local_freqs, s_freq
+
+
 def EMD_Reconstruct(df_values, seq_length, input_features):
 
     # Define the level
@@ -54,38 +95,253 @@ def EMD_Reconstruct(df_values, seq_length, input_features):
     else:
         input_features = input_trend
 
-    lasso_sklearn = Lasso(alpha=0.1, max_iter=1000, fit_intercept=False)  # ETTm, ECL, Traffic, Weather, Solar, Air
-    # lasso_sklearn = Lasso(alpha=0.01, max_iter=1000, fit_intercept=False)  # River
-    # lasso_sklearn = Lasso(alpha=0.001, max_iter=1000, fit_intercept=False)  # ETTh, BTC, ETH
+    lasso_sklearn = Lasso(alpha=LASSO_ALPHA, max_iter=LASSO_MAX_ITER, fit_intercept=False)
     lasso_sklearn.fit(input_features.transpose(1, 0), df_values)
     return lasso_sklearn.coef_
 
 
-def EMD_Predict(coef, input_length, pred_length, local_freq, sin_waves, cos_waves):
-    pred_features = []
-    sin_features = []
-    cos_features = []
-    pred_trend = np.ones(input_length + pred_length)
-    pred_features.append(pred_trend)
+def _lasso_cd(features, y, alpha, max_iter, tol):
+    # Coordinate descent on the Gram matrix for a batch of problems with the same number of features,
+    # minimizing 1 / (2n) * ||y - w @ features||^2 + alpha * ||w||_1 like sklearn.linear_model.Lasso
+    n = features.shape[-1]
+    gram = features @ features.transpose(0, 2, 1) / n  # [B P P]
+    corr = (features @ y[:, :, None])[:, :, 0] / n  # [B P]
+    diag = np.diagonal(gram, axis1=1, axis2=2)
+    inv_diag = np.where(diag > 0, 1. / np.maximum(diag, 1e-300), 0.)  # all-zero features keep a zero weight
+    w = np.zeros_like(corr)
+    active = np.arange(w.shape[0])
+    for _ in range(max_iter):
+        w_a, gram_a, corr_a, diag_a, inv_a = w[active], gram[active], corr[active], diag[active], inv_diag[active]
+        w_max = np.zeros(len(active))
+        d_w_max = np.zeros(len(active))
+        for j in range(w.shape[1]):
+            w_j = w_a[:, j].copy()
+            rho = corr_a[:, j] - np.einsum('bp,bp->b', gram_a[:, j], w_a) + diag_a[:, j] * w_j
+            w_a[:, j] = np.sign(rho) * np.maximum(np.abs(rho) - alpha, 0.) * inv_a[:, j]
+            d_w_max = np.maximum(d_w_max, np.abs(w_a[:, j] - w_j))
+            w_max = np.maximum(w_max, np.abs(w_a[:, j]))
+        w[active] = w_a
+        active = active[d_w_max > tol * w_max]
+        if len(active) == 0:
+            break
+    return w
 
-    local_freq = local_freq.reshape(-1)
-    local_freq = local_freq.tolist()
-    local_freq = list(set(local_freq))
-    lasso_sklearn = Lasso()
-
-    coef_num = 1
-    for g_p in local_freq:
-        if g_p == 0:
-            continue
-        sin_features.append(sin_waves[int(g_p), :])
-        cos_features.append(cos_waves[int(g_p), :])
-        coef_num += 2
-    lasso_sklearn.coef_ = coef[:coef_num]
-    lasso_sklearn.intercept_ = 0
-
-    pred_features.extend(sin_features)
-    pred_features.extend(cos_features)
-    pred_features = np.array(pred_features).transpose(1, 0)
-    prediction_seq = lasso_sklearn.predict(pred_features)
-
-    return prediction_seq
+
+def EMD_Reconstruct_Batch(windows, local_freqs, seq_length, sin_waves, cos_waves, batch_size=4096):
+    """
+    Fit the Lasso of EMD_Reconstruct for many windows at once. Problems are grouped by their number of
+    frequencies so that each group is one stacked coordinate descent without padding.
+    :param windows: [N, seq_length] input sequences
+    :param local_freqs: N frequency arrays as returned by EMD_Find_Freq
+    :return: N coefficient vectors (level, sin, cos), as EMD_Reconstruct returns them
+    """
+    coefs = [None] * len(windows)
+    counts = np.array([local_freq.shape[0] for local_freq in local_freqs], dtype=np.int64)
+    for k in np.unique(counts):
+        group = np.nonzero(counts == k)[0]
+        for start in range(0, len(group), batch_size):
+            batch = group[start: start + batch_size]
+            freq = np.array([local_freqs[i] for i in batch], dtype=np.int64).reshape(len(batch), k)
+            features = np.concatenate([np.ones([len(batch), 1, seq_length]),
+                                       sin_waves[freq, :seq_length], cos_waves[freq, :seq_length]], axis=1)
+            w = _lasso_cd(features, windows[batch], LASSO_ALPHA, LASSO_MAX_ITER, LASSO_TOL)
+            for i, b in enumerate(batch):
+                coefs[b] = w[i]
+    return coefs
+
+
+def EMD_Waves(input_length, pred_length):
+    # sin/cos basis of every period input_length / i over the input and prediction steps, row 0 stays zero
+    i = np.arange(input_length + 1).reshape(-1, 1)
+    j = np.arange(input_length + pred_length).reshape(1, -1)
+    sin_waves = np.sin((2 * np.pi * i / input_length) * j)
+    cos_waves = np.cos((2 * np.pi * i / input_length) * j)
+    cos_waves[0] = 0
+    return sin_waves, cos_waves
+
+
+def EMD_Predict_Batch(first_row, indptr, freq, weight, sin_waves, cos_waves):
+    """
+    The Lasso forecasts of consecutive (window, variable) rows of the ragged layout of EMD_Precompute, computed
+    as one coefficients-times-basis matmul. The weights are used in the order they were fitted in.
+    :param first_row: index of the first row, indptr is indptr[first_row: last_row + 1] of the full store
+    :param freq, weight: the full ragged arrays, only the part of the rows is read
+    :param sin_waves, cos_waves: [input_len + 1, T] basis at the time steps to forecast
+    :return: [rows, T]
+    """
+    indptr = np.asarray(indptr, dtype=np.int64)
+    rows = indptr.shape[0] - 1
+    count = np.diff(indptr)
+    local_freq = np.asarray(freq[indptr[0]: indptr[-1]], dtype=np.int64)
+    local_weight = np.asarray(weight[first_row + 2 * indptr[0]: first_row + rows + 2 * indptr[-1]], dtype=np.float64)
+    local_ptr = indptr[:-1] - indptr[0]
+    weight_ptr = np.arange(rows) + 2 * local_ptr  # level weight of each row, followed by k sin and k cos weights
+
+    row_of = np.repeat(np.arange(rows), count)
+    pos = np.arange(local_freq.shape[0]) - local_ptr[row_of]
+    coef = np.zeros([rows, 2 * sin_waves.shape[0]])
+    coef[row_of, local_freq] = local_weight[weight_ptr[row_of] + 1 + pos]
+    coef[row_of, sin_waves.shape[0] + local_freq] = local_weight[weight_ptr[row_of] + 1 + count[row_of] + pos]
+    return local_weight[weight_ptr].reshape(-1, 1) + coef @ np.concatenate([sin_waves, cos_waves], axis=0)
+
+
+def EMD_Settings(mode='emd'):
+    # Every setting that changes the output of EMD_Precompute, used to key the EMD cache
+    settings = {'savgol_window': SAVGOL_WINDOW, 'savgol_order': SAVGOL_ORDER, 'min_amp': EMD_MIN_AMP,
+                'alpha': LASSO_ALPHA, 'max_iter': LASSO_MAX_ITER, 'solver': 'batched_cd', 'tol': LASSO_TOL,
+                'mode': mode}
+    if mode == 'emd':
+        settings.update({'std_thr': EMD_STD_THR, 'range_thr': EMD_RANGE_THR})
+    else:
+        settings.update({'fft_max_freq': FFT_MAX_FREQ, 'fft_rel_amp': FFT_REL_AMP})
+    return settings
+
+
+# Per-process state of the precompute workers, filled once by _init_worker so that the series and
+# the sin/cos tables are not pickled again for every chunk.
+_worker_state = {}
+
+
+def _init_worker(data_x, seq_length, sin_waves, cos_waves, mode):
+    warnings.filterwarnings('ignore')
+    _worker_state['mode'] = mode
+    _worker_state['data_x'] = data_x
+    _worker_state['seq_length'] = seq_length
+    _worker_state['sin_waves'] = sin_waves
+    _worker_state['cos_waves'] = cos_waves
+
+
+def EMD_Windows(data_x, start, end, seq_length, sin_waves, cos_waves, mode='emd'):
+    """
+    Detect the periods of windows [start, end) of data_x and fit their Lasso weights together
+    :return: count [windows, V] of detected frequencies, freq (int16), weight (float32) and sfreq [windows, V]
+    (int16), the rows ordered as window * V + var
+    """
+    count = np.zeros([end - start, data_x.shape[1]], dtype=np.int64)
+    sfreq = np.zeros([end - start, data_x.shape[1]], dtype=np.int16)
+    # [windows * V, seq_length], ordered as the rows of the store
+    windows = sliding_window_view(data_x[start: end + seq_length - 1], seq_length, axis=0).reshape(-1, seq_length)
+    if mode == 'fft':
+        freq, s_freq = FFT_Find_Freq(windows, seq_length)
+        count[:] = np.array([local_freq.shape[0] for local_freq in freq]).reshape(end - start, -1)
+        sfreq[:] = s_freq.reshape(end - start, -1)
+    else:
+        freq = []
+        for i in range(start, end):
+            for j in range(data_x.shape[1]):
+                local_freq, s_freq = EMD_Find_Freq(data_x[i: i + seq_length, j], seq_length)
+                count[i - start, j] = local_freq.shape[0]
+                sfreq[i - start, j] = s_freq
+                freq.append(local_freq)
+    # the Lasso fits of all the windows are solved together
+    weight = EMD_Reconstruct_Batch(windows, freq, seq_length, sin_waves, cos_waves)
+    freq = np.concatenate(freq).astype(np.int16)
+    weight = np.concatenate(weight).astype(np.float32)
+    return count, freq, weight, sfreq
+
+
+def _compute_chunk(bounds):
+    start, end = bounds
+    count, freq, weight, sfreq = EMD_Windows(_worker_state['data_x'], start, end, _worker_state['seq_length'],
+                                             _worker_state['sin_waves'], _worker_state['cos_waves'],
+                                             _worker_state['mode'])
+    return start, end, count, freq, weight, sfreq
+
+
+def _chunk_file(chunk_path, start, end):
+    return os.path.join(chunk_path, '{}_{}.npz'.format(start, end))
+
+
+def EMD_Precompute(data_x, seq_length, sin_waves, cos_waves, chunk_path, num_workers=0, chunk_size=256,
+                   mode='emd', shard=0, num_shards=1):
+    """
+    Run EMD_Find_Freq (or FFT_Find_Freq) and EMD_Reconstruct_Batch for every window of data_x with a pool
+    of processes.
+    Windows are split into chunks of chunk_size, each chunk is saved under chunk_path as soon as it
+    finishes, and chunks already on disk are skipped, so an interrupted run resumes where it stopped.
+    The results are ragged: row r = window * V + var owns freq[indptr[r]:indptr[r + 1]] and the
+    1 + 2k Lasso weights weight[r + 2 * indptr[r]:r + 1 + 2 * indptr[r + 1]] (level, sin, cos).
+    :param num_workers: the number of worker processes, 0 means all CPU cores
+    :param mode: 'emd' detects the periods with EMD_Find_Freq, 'fft' with the faster FFT_Find_Freq
+    :param shard: with num_shards > 1, only the chunks shard, shard + num_shards, ... are computed (e.g. by
+    one of num_shards machines sharing chunk_path) and None is returned; EMD_Assemble collects them
+    :return: indptr [windows * V + 1], freq (int16), weight (float32) and sfreq [windows, V] (int16)
+    """
+    window_num = len(data_x) - seq_length
+    if not os.path.exists(chunk_path):
+        os.makedirs(chunk_path)
+    bounds = _chunk_bounds(window_num, chunk_size)[shard::num_shards]
+    todo = [bound for bound in bounds if not os.path.exists(_chunk_file(chunk_path, *bound))]
+    if num_workers <= 0:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(todo)))
+
+    if len(todo) < len(bounds):
+        print('Resuming EMD precomputation: {}/{} chunks already done'.format(len(bounds) - len(todo), len(bounds)))
+    done_windows = 0
+    todo_windows = sum(end - start for start, end in todo)
+    time_now = time.time()
+
+    def save_chunk(result):
+        start, end, count, freq, weight, sfreq = result
+        tmp_file = os.path.join(chunk_path, '{}_{}.tmp.npz'.format(start, end))
+        np.savez(tmp_file, count=count, freq=freq, weight=weight, sfreq=sfreq)
+        os.replace(tmp_file, _chunk_file(chunk_path, start, end))
+        return end - start
+
+    def report(done):
+        speed = done / max(time.time() - time_now, 1e-6)
+        left_time = (todo_windows - done) / max(speed, 1e-6)
+        print('\tEMD windows: {}/{} | speed: {:.2f} windows/s; left time: {:.1f}s'.
+              format(done, todo_windows, speed, left_time))
+
+    if num_workers == 1:
+        _init_worker(data_x, seq_length, sin_waves, cos_waves, mode)
+        for bound in todo:
+            done_windows += save_chunk(_compute_chunk(bound))
+            report(done_windows)
+    elif len(todo) > 0:
+        with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                  initargs=(data_x, seq_length, sin_waves, cos_waves, mode)) as pool:
+            for result in pool.imap_unordered(_compute_chunk, todo):
+                done_windows += save_chunk(result)
+                report(done_windows)
+
+    if num_shards > 1:
+        return None
+    return EMD_Assemble(chunk_path, window_num, data_x.shape[1], chunk_size)
+
+
+def _chunk_bounds(window_num, chunk_size):
+    return [(start, min(start + chunk_size, window_num)) for start in range(0, window_num, chunk_size)]
+
+
+def EMD_Missing(chunk_path, window_num, chunk_size):
+    """
+    :return: the indices of the chunks of window_num windows not saved under chunk_path yet
+    """
+    return [index for index, bound in enumerate(_chunk_bounds(window_num, chunk_size))
+            if not os.path.exists(_chunk_file(chunk_path, *bound))]
+
+
+def EMD_Assemble(chunk_path, window_num, var_num, chunk_size=256):
+    """
+    Concatenate the chunks saved under chunk_path by EMD_Precompute into its ragged results
+    """
+    count = np.zeros([window_num, var_num], dtype=np.int64)
+    emd_sfreq = np.zeros([window_num, var_num], dtype=np.int16)
+    emd_freq = []
+    emd_weight = []
+    for start, end in _chunk_bounds(window_num, chunk_size):
+        chunk = np.load(_chunk_file(chunk_path, start, end))
+        if chunk['sfreq'].shape != (end - start, var_num):
+            raise ValueError('EMD chunk {}_{} has shape {}, expected {}'.format(
+                start, end, chunk['sfreq'].shape, (end - start, var_num)))
+        count[start:end] = chunk['count']
+        emd_sfreq[start:end] = chunk['sfreq']
+        emd_freq.append(chunk['freq'])
+        emd_weight.append(chunk['weight'])
+    indptr = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(count.reshape(-1))])
+    emd_freq = np.concatenate(emd_freq) if emd_freq else np.zeros(0, dtype=np.int16)
+    emd_weight = np.concatenate(emd_weight) if emd_weight else np.zeros(0, dtype=np.float32)
+    return indptr, emd_freq, emd_weight, emd_sfreq
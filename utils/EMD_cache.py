@@ -0,0 +1,381 @@
+import os
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.EMD import EMD_Precompute, EMD_Assemble, EMD_Missing, EMD_Predict_Batch, EMD_Settings, EMD_Windows
+
+EMD_STORE_FORMAT = 2  # ragged int16 frequencies / float32 weights
+
+
+def EMD_Key(data, seq_length, mode='emd'):
+    # Content address of the EMD results: the normalized series, the window length and the EMD/Lasso settings.
+    # The prediction length and the split borders are not part of it, as every window is fitted on its input only.
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps({'shape': list(data.shape), 'seq_length': seq_length, 'format': EMD_STORE_FORMAT,
+                              'settings': EMD_Settings(mode)}, sort_keys=True).encode())
+    hasher.update(data.tobytes())
+    return hasher.hexdigest()[:16]
+
+
+class EMD_Store():
+    """
+    Memory-mapped EMD results of every window of a series, in the ragged layout returned by EMD_Precompute.
+    DataLoader workers opening the same store share its pages, and the size on disk follows the number of
+    detected frequencies instead of a fixed number of slots per window.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+        self.freq = np.load(os.path.join(path, 'freq.npy'), mmap_mode='r')
+        self.weight = np.load(os.path.join(path, 'weight.npy'), mmap_mode='r')
+        self.sfreq = np.load(os.path.join(path, 'sfreq.npy'), mmap_mode='r')
+        self.vars = self.sfreq.shape[1]
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return self.sfreq.shape[0]
+
+    def predict(self, start, end, sin_waves, cos_waves, out, block_size=256):
+        """
+        Write the forecasts of windows [start, end) at the time steps of sin_waves/cos_waves [input_len + 1, T]
+        to out [end - start, T, V]
+        """
+        for block_start in range(start, end, block_size):
+            block_end = min(block_start + block_size, end)
+            rows = EMD_Predict_Batch(block_start * self.vars,
+                                     self.indptr[block_start * self.vars: block_end * self.vars + 1],
+                                     self.freq, self.weight, sin_waves, cos_waves)
+            out[block_start - start: block_end - start] = \
+                rows.reshape(block_end - block_start, self.vars, -1).transpose(0, 2, 1)
+        return out
+
+    @staticmethod
+    def save(path, indptr, freq, weight, sfreq, meta):
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        # every array is replaced through a temporary file, stores still mapped by other processes keep
+        # reading the old files
+        for name, array in [('indptr', indptr), ('freq', freq), ('weight', weight), ('sfreq', sfreq)]:
+            tmp_path = os.path.join(path, name + '.tmp.npy')
+            np.save(tmp_path, array)
+            os.replace(tmp_path, os.path.join(path, name + '.npy'))
+        # meta.json is written last, a store without it is incomplete
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+def EMD_Cache(data, seq_length, sin_waves, cos_waves, cache_root, num_workers=0, chunk_size=256, mode='emd',
+              shard=None):
+    """
+    Open the EMD_Store of every window of data at cache_root/<EMD_Key>, computing it first if needed.
+    The results are indexed by the absolute start of the window in data, so that all splits (and runs with
+    different prediction lengths) share one store and only slice it.
+    With shard = (i, n), only the i-th of n shards of the chunks is computed into the chunk folder of the store
+    (which the n jobs share, e.g. on a shared filesystem) and None is returned; shard = 'merge' runs EMD_Merge.
+    """
+    cache_path = os.path.join(cache_root, EMD_Key(data, seq_length, mode))
+    if os.path.exists(os.path.join(cache_path, 'meta.json')):
+        return EMD_Store(cache_path)
+    if shard == 'merge':
+        return EMD_Merge(data, seq_length, cache_root, mode)
+
+    chunk_path = os.path.join(cache_path, 'chunks')
+    plan = _shard_plan(chunk_path, data.shape[0] - seq_length, chunk_size, None if shard is None else shard[1])
+    if shard is not None:
+        print('Finding EMD-based freqs of shard {} of {}'.format(shard[0], shard[1]))
+        EMD_Precompute(data, seq_length, sin_waves, cos_waves, chunk_path, num_workers=num_workers,
+                       chunk_size=plan['chunk_size'], mode=mode, shard=shard[0], num_shards=shard[1])
+        return None
+    print('Finding EMD-based freqs')
+    indptr, freq, weight, sfreq = EMD_Precompute(
+        data, seq_length, sin_waves, cos_waves, chunk_path, num_workers=num_workers,
+        chunk_size=plan['chunk_size'], mode=mode)
+    _save_cache(cache_path, data, seq_length, mode, indptr, freq, weight, sfreq)
+    return EMD_Store(cache_path)
+
+
+def _shard_plan(chunk_path, window_num, chunk_size, num_shards):
+    # chunk size and number of shards of a sharded precomputation, fixed by its first job in shards.json so that
+    # all jobs (and a single-process run resuming their chunks) agree on the chunk boundaries
+    plan_path = os.path.join(chunk_path, 'shards.json')
+    if os.path.exists(plan_path):
+        with open(plan_path) as f:
+            plan = json.load(f)
+        if num_shards is not None and (plan['chunk_size'] != chunk_size or plan['num_shards'] != num_shards):
+            raise ValueError('EMD shards under {} were started with chunk size {} and {} shards, got {} and {}'.format(
+                chunk_path, plan['chunk_size'], plan['num_shards'], chunk_size, num_shards))
+        return plan
+    plan = {'windows': window_num, 'chunk_size': chunk_size, 'num_shards': num_shards}
+    if num_shards is not None:
+        if not os.path.exists(chunk_path):
+            os.makedirs(chunk_path)
+        tmp_path = os.path.join(chunk_path, 'shards.{}.tmp.json'.format(os.getpid()))
+        with open(tmp_path, 'w') as f:
+            json.dump(plan, f, indent=2)
+        os.replace(tmp_path, plan_path)
+    return plan
+
+
+def _save_cache(cache_path, data, seq_length, mode, indptr, freq, weight, sfreq):
+    print('Saving EMD-based freqs ...')
+    EMD_Store.save(cache_path, indptr, freq, weight, sfreq,
+                   {'rows': data.shape[0], 'vars': data.shape[1], 'seq_length': seq_length,
+                    'windows': sfreq.shape[0], 'format': EMD_STORE_FORMAT, 'settings': EMD_Settings(mode)})
+    shutil.rmtree(os.path.join(cache_path, 'chunks'))
+
+
+def EMD_Merge(data, seq_length, cache_root, mode='emd'):
+    """
+    Assemble the EMD_Store of EMD_Cache from the chunks computed by its shards, after checking that they
+    cover every window of data. Nothing is computed here: missing chunks raise a ValueError naming the
+    shards to (re)run.
+    """
+    cache_path = os.path.join(cache_root, EMD_Key(data, seq_length, mode))
+    if os.path.exists(os.path.join(cache_path, 'meta.json')):
+        return EMD_Store(cache_path)
+    chunk_path = os.path.join(cache_path, 'chunks')
+    if not os.path.exists(os.path.join(chunk_path, 'shards.json')):
+        raise ValueError('No EMD shards were computed under {}'.format(chunk_path))
+    plan = _shard_plan(chunk_path, data.shape[0] - seq_length, None, None)
+    missing = EMD_Missing(chunk_path, plan['windows'], plan['chunk_size'])
+    if missing:
+        shards = sorted(set(index % plan['num_shards'] for index in missing))
+        raise ValueError('EMD shards {} of {} are incomplete: {} of {} chunks missing under {}'.format(
+            shards, plan['num_shards'], len(missing), -(-plan['windows'] // plan['chunk_size']), chunk_path))
+    print('Merging EMD-based freqs of {} shards'.format(plan['num_shards']))
+    indptr, freq, weight, sfreq = EMD_Assemble(chunk_path, plan['windows'], data.shape[1], plan['chunk_size'])
+    _save_cache(cache_path, data, seq_length, mode, indptr, freq, weight, sfreq)
+    return EMD_Store(cache_path)
+
+
+def EMD_Prefix_Hash(raw):
+    # fingerprint of the raw (unnormalized) rows an append store was computed from
+    return hashlib.sha1(np.ascontiguousarray(raw, dtype=np.float64).tobytes()).hexdigest()
+
+
+def EMD_Append(raw, scaler, seq_length, sin_waves, cos_waves, cache_root, num_workers=0, chunk_size=256,
+               mode='emd'):
+    """
+    Incremental version of EMD_Cache for series that keep growing. The store at cache_root/append_<key>
+    only depends on the number of variables, the window length and the EMD/Lasso settings; when raw has
+    new rows beyond the ones the store was computed from (and those are unchanged), only the new windows
+    are computed and appended.
+    The windows are normalized with the scaler statistics pinned when the store was first built, since the
+    training scaler is refitted as the series grows; EMD_Initial maps the forecasts to the current scaler.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps({'vars': raw.shape[1], 'seq_length': seq_length, 'format': EMD_STORE_FORMAT,
+                              'settings': EMD_Settings(mode)}, sort_keys=True).encode())
+    cache_path = os.path.join(cache_root, 'append_' + hasher.hexdigest()[:16])
+    meta_path = os.path.join(cache_path, 'meta.json')
+
+    emd_store = None
+    if os.path.exists(meta_path):
+        emd_store = EMD_Store(cache_path)
+        meta = emd_store.meta
+        if meta['rows'] > raw.shape[0] or EMD_Prefix_Hash(raw[:meta['rows']]) != meta['prefix']:
+            print('EMD append store does not match the history of the data, recomputing it')
+            emd_store = None
+        elif meta['rows'] == raw.shape[0]:
+            return emd_store
+    if emd_store is None:
+        if os.path.exists(cache_path):
+            shutil.rmtree(cache_path)
+        meta = {'vars': raw.shape[1], 'seq_length': seq_length, 'format': EMD_STORE_FORMAT,
+                'settings': EMD_Settings(mode), 'mean': scaler.mean_.tolist(), 'scale': scaler.scale_.tolist()}
+        done_windows = 0
+    else:
+        done_windows = len(emd_store)
+
+    # window w covers rows [w, w + seq_length), the new windows start from the first window not in the store
+    data = (raw[done_windows:] - np.array(meta['mean'])) / np.array(meta['scale'])
+    chunk_path = os.path.join(cache_path, 'chunks_{}'.format(done_windows))
+    print('Finding EMD-based freqs of {} new windows'.format(data.shape[0] - seq_length))
+    indptr, freq, weight, sfreq = EMD_Precompute(
+        data, seq_length, sin_waves, cos_waves, chunk_path, num_workers=num_workers, chunk_size=chunk_size,
+        mode=mode)
+    if emd_store is not None:
+        indptr = np.concatenate([emd_store.indptr[:-1], indptr + emd_store.indptr[-1]])
+        freq = np.concatenate([emd_store.freq, freq])
+        weight = np.concatenate([emd_store.weight, weight])
+        sfreq = np.concatenate([emd_store.sfreq, sfreq])
+        del emd_store
+    print('Saving EMD-based freqs ...')
+    meta.update({'rows': raw.shape[0], 'windows': sfreq.shape[0], 'prefix': EMD_Prefix_Hash(raw)})
+    EMD_Store.save(cache_path, indptr, freq, weight, sfreq, meta)
+    shutil.rmtree(chunk_path)
+    # the mapped forecasts only cover the old windows
+    for name in os.listdir(cache_path):
+        if name.startswith('pred_'):
+            os.remove(os.path.join(cache_path, name))
+    return EMD_Store(cache_path)
+
+
+def EMD_Initial(emd_store, start, end, input_len, pred_len, sin_waves, cos_waves, mmap=False, scaler=None):
+    """
+    The EMD initial forecasts [end - start, pred_len, V] of windows [start, end) as one array, so that
+    __getitem__ only slices it. With mmap, the forecasts of all windows of the store are computed once and
+    saved next to it as pred_<pred_len>.npy, which later runs and the DataLoader workers map instead.
+    Forecasts of an EMD_Append store are mapped from its pinned normalization to scaler.
+    """
+    emd_pred = _EMD_Initial(emd_store, start, end, input_len, pred_len, sin_waves, cos_waves, mmap)
+    if scaler is None or 'mean' not in emd_store.meta:
+        return emd_pred
+    mean, scale = np.array(emd_store.meta['mean']), np.array(emd_store.meta['scale'])
+    if np.allclose(mean, scaler.mean_) and np.allclose(scale, scaler.scale_):
+        return emd_pred
+    return (emd_pred * (scale / scaler.scale_) + (mean - scaler.mean_) / scaler.scale_).astype(np.float32)
+
+
+def _EMD_Initial(emd_store, start, end, input_len, pred_len, sin_waves, cos_waves, mmap):
+    sin_pred = sin_waves[:, input_len: input_len + pred_len]
+    cos_pred = cos_waves[:, input_len: input_len + pred_len]
+    if not mmap:
+        emd_pred = np.zeros([end - start, pred_len, emd_store.vars], dtype=np.float32)
+        return emd_store.predict(start, end, sin_pred, cos_pred, emd_pred)
+
+    pred_path = os.path.join(emd_store.path, 'pred_{}.npy'.format(pred_len))
+    if not os.path.exists(pred_path):
+        tmp_path = os.path.join(emd_store.path, 'pred_{}.tmp.npy'.format(pred_len))
+        emd_pred = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                             shape=(len(emd_store), pred_len, emd_store.vars))
+        emd_store.predict(0, len(emd_store), sin_pred, cos_pred, emd_pred)
+        emd_pred.flush()
+        del emd_pred
+        os.replace(tmp_path, pred_path)
+    return np.load(pred_path, mmap_mode='r')[start:end]
+
+
+def EMD_Stream_Key(source, mean, scale, columns, seq_length, mode='emd'):
+    # Address of the EMD results of a streamed table, which is not hashed as a whole: the stat of its values
+    # file, the normalization and the columns of the windows, the window length and the EMD/Lasso settings.
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps({'source': source, 'columns': [int(col) for col in columns], 'seq_length': seq_length,
+                              'format': EMD_STORE_FORMAT, 'settings': EMD_Settings(mode)}, sort_keys=True).encode())
+    hasher.update(np.ascontiguousarray(mean, dtype=np.float64).tobytes())
+    hasher.update(np.ascontiguousarray(scale, dtype=np.float64).tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def EMD_Chunk(data, window_num, seq_length, sin_waves, cos_waves, chunk_file=None, mode='emd'):
+    """
+    EMD_Windows of the first window_num windows of data. With chunk_file, the results are saved there as an
+    EMD_Precompute chunk and loaded from it by later calls, e.g. the next epochs of Dataset_Stream.
+    :return: count [window_num, V], freq, weight and sfreq [window_num, V] as returned by EMD_Windows
+    """
+    if chunk_file is not None and os.path.exists(chunk_file):
+        chunk = np.load(chunk_file)
+        return chunk['count'], chunk['freq'], chunk['weight'], chunk['sfreq']
+    count, freq, weight, sfreq = EMD_Windows(data, 0, window_num, seq_length, sin_waves, cos_waves, mode)
+    if chunk_file is not None:
+        chunk_path = os.path.dirname(chunk_file)
+        if not os.path.exists(chunk_path):
+            os.makedirs(chunk_path, exist_ok=True)
+        # concurrent runs may write the same chunk, each through its own file
+        tmp_file = '{}.{}.tmp.npz'.format(chunk_file[:-4], os.getpid())
+        np.savez(tmp_file, count=count, freq=freq, weight=weight, sfreq=sfreq)
+        os.replace(tmp_file, chunk_file)
+    return count, freq, weight, sfreq
+
+
+class EMD_Lazy():
+    """
+    On-demand alternative to EMD_Cache + EMD_Initial. The initial forecast and the dominant periods of a
+    window are computed the first time it is requested and kept in an LRU of lru_size windows, so training
+    starts without waiting for the precomputation of the whole series. Each DataLoader worker keeps its own
+    LRU; with cache_path, computed windows are also written to memory-mapped arrays shared by all workers
+    and later runs.
+    """
+    def __init__(self, data, input_len, pred_len, sin_waves, cos_waves, mode='emd', lru_size=4096,
+                 cache_path=None):
+        self.data = data
+        self.input_len = input_len
+        self.pred_len = pred_len
+        self.sin_waves = sin_waves
+        self.cos_waves = cos_waves
+        self.sin_pred = sin_waves[:, input_len: input_len + pred_len]
+        self.cos_pred = cos_waves[:, input_len: input_len + pred_len]
+        self.mode = mode
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.windows = data.shape[0] - input_len
+        self.vars = data.shape[1]
+
+        self.cache_path = cache_path
+        self.arrays = None
+        if cache_path is not None and not os.path.exists(os.path.join(cache_path, 'done.npy')):
+            if not os.path.exists(cache_path):
+                os.makedirs(cache_path)
+            for name, shape, dtype in [('pred', (self.windows, pred_len, self.vars), np.float32),
+                                       ('sfreq', (self.windows, self.vars), np.int16)]:
+                np.lib.format.open_memmap(os.path.join(cache_path, name + '.npy'), mode='w+', dtype=dtype,
+                                          shape=shape).flush()
+            # done.npy is created last, it flags the windows whose pred and sfreq are written
+            np.save(os.path.join(cache_path, 'done.npy'), np.zeros(self.windows, dtype=np.uint8))
+
+    def __getstate__(self):
+        # the memory maps are reopened by each worker process
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def _arrays(self):
+        if self.arrays is None and self.cache_path is not None:
+            self.arrays = {name: np.load(os.path.join(self.cache_path, name + '.npy'), mmap_mode='r+')
+                           for name in ['pred', 'sfreq', 'done']}
+        return self.arrays
+
+    def _compute(self, index):
+        count, freq, weight, sfreq = EMD_Windows(self.data, index, index + 1, self.input_len,
+                                                 self.sin_waves, self.cos_waves, self.mode)
+        indptr = np.concatenate([[0], np.cumsum(count.reshape(-1))])
+        pred = EMD_Predict_Batch(0, indptr, freq, weight, self.sin_pred, self.cos_pred)
+        return pred.T.astype(np.float32), sfreq[0]
+
+    def window(self, index):
+        """
+        :return: the initial forecast [pred_len, V] and the dominant periods [V] of the window starting at index
+        """
+        if index in self.lru:
+            self.lru.move_to_end(index)
+            return self.lru[index]
+        arrays = self._arrays()
+        if arrays is not None and arrays['done'][index]:
+            value = np.array(arrays['pred'][index]), np.array(arrays['sfreq'][index])
+        else:
+            value = self._compute(index)
+            if arrays is not None:
+                arrays['pred'][index], arrays['sfreq'][index] = value
+                arrays['done'][index] = 1
+        self.lru[index] = value
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+        return value
+
+    def views(self, start):
+        """
+        :return: array-like views of the forecasts and dominant periods of the windows from start on, indexed
+        like the arrays of EMD_Initial and EMD_Store.sfreq sliced at start
+        """
+        return EMD_Lazy_View(self, 0, start), EMD_Lazy_View(self, 1, start)
+
+
+class EMD_Lazy_View():
+    def __init__(self, emd_lazy, field, start):
+        self.emd_lazy = emd_lazy
+        self.field = field
+        self.start = start
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if np.ndim(key[0]) == 0:
+            return self.emd_lazy.window(self.start + int(key[0]))[self.field][key[1:]]
+        value = np.stack([self.emd_lazy.window(self.start + int(index))[self.field] for index in key[0]])
+        return value[(slice(None),) + key[1:]]
@@ -16,13 +16,18 @@ class RevIN(nn.Module):
         if self.affine:
             self._init_params()
 
-    def forward(self, x, mode: str):
+    def forward(self, x, mode: str, stats=None):
+        """
+        Stateless: mode 'stats' returns the statistics (mean, stdev) of x, which are passed back as stats to
+        'norm' and 'denorm'. Nothing is stored on the module, so one instance can serve concurrent forwards
+        and be traced or exported.
+        """
         if mode == 'stats':
-            self._get_statistics(x)
+            return self._get_statistics(x)
         elif mode == 'norm':
-            x = self._normalize(x)
+            x = self._normalize(x, *stats)
         elif mode == 'denorm':
-            x = self._denormalize(x)
+            x = self._denormalize(x, *stats)
         else:
             raise NotImplementedError
         return x
@@ -34,21 +39,22 @@ class RevIN(nn.Module):
 
     def _get_statistics(self, x):
         dim2reduce = tuple(range(1, x.ndim - 1))
-        self.mean = torch.mean(x, dim=dim2reduce, keepdim=True).detach()
-        self.stdev = torch.sqrt(torch.var(x, dim=dim2reduce, keepdim=True, unbiased=False) + self.eps).detach()
+        mean = torch.mean(x, dim=dim2reduce, keepdim=True).detach()
+        stdev = torch.sqrt(torch.var(x, dim=dim2reduce, keepdim=True, unbiased=False) + self.eps).detach()
+        return mean, stdev
 
-    def _normalize(self, x):
-        x = x - self.mean
-        x = x / self.stdev
+    def _normalize(self, x, mean, stdev):
+        x = x - mean
+        x = x / stdev
         if self.affine:
             x = x * self.affine_weight
             x = x + self.affine_bias
         return x
 
-    def _denormalize(self, x):
+    def _denormalize(self, x, mean, stdev):
         if self.affine:
             x = x - self.affine_bias
             x = x / (self.affine_weight + self.eps * self.eps)
-        x = x * self.stdev
-        x = x + self.mean
+        x = x * stdev
+        x = x + mean
         return x
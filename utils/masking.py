@@ -1,11 +1,67 @@
 import torch
+try:
+    # also covers torch.export
+    from torch.compiler import is_compiling as _is_compiling
+except ImportError:
+    # torch 2.1 (requirements.txt) only has the dynamo check
+    from torch._dynamo import is_compiling as _is_compiling
+
+# One [L, S] mask per (kind, shape, device, dtype) is built on first use and then broadcast to the
+# [B V P L S] / [B V P P] scores (expand is a view), instead of materializing and copying the full mask on
+# every forward. Mask_Stats counts the masks actually allocated.
+_mask_cache = {}
+_mask_stats = {'allocations': 0, 'bytes': 0}
+
+
+def _build_mask(kind, L, S, dtype, keep):
+    if kind == 'diag':
+        mask = torch.eye(L, S, dtype=torch.bool)
+    elif kind == 'causal':
+        mask = torch.triu(torch.ones([L, S], dtype=torch.bool), diagonal=1)
+    else:
+        raise ValueError('Unknown mask kind: {}'.format(kind))
+    if keep:
+        return ~mask
+    if dtype != torch.bool:
+        return torch.zeros([L, S], dtype=dtype).masked_fill_(mask, float('-inf'))
+    return mask
+
+
+def Cached_Mask(kind, L, S, device='cpu', dtype=torch.bool, keep=False):
+    """
+    :param kind: 'diag' masks the diagonal, 'causal' the positions after the query
+    :param dtype: torch.bool for a mask that is True where masked, a floating dtype for the additive bias
+    (-inf where masked, 0 elsewhere)
+    :param keep: whether the boolean mask is True where attended instead, as scaled_dot_product_attention takes it
+    :return: the cached [L, S] mask, to be broadcast and never written to
+    """
+    device = torch.device(device)
+    if torch.jit.is_tracing() or _is_compiling():
+        # a traced, exported or compiled graph builds its masks itself, the cache keeps no traced (or fake) values
+        return _build_mask(kind, L, S, dtype, keep).to(device)
+    key = (kind, L, S, device, dtype, keep)
+    if key not in _mask_cache:
+        with torch.no_grad():
+            mask = _build_mask(kind, L, S, dtype, keep)
+            _mask_cache[key] = mask.to(device)
+        _mask_stats['allocations'] += 1
+        _mask_stats['bytes'] += mask.element_size() * mask.nelement()
+    return _mask_cache[key]
+
+
+def Mask_Stats():
+    return dict(_mask_stats)
+
+
+def Mask_Cache_Clear():
+    _mask_cache.clear()
+    _mask_stats['allocations'] = 0
+    _mask_stats['bytes'] = 0
 
 
 class OffDiagMask_PointLevel():
     def __init__(self, B, V, P, L, device="cpu"):
-        with torch.no_grad():
-            _mask = torch.eye(L, L, dtype=torch.bool).to(device)
-            self._mask = _mask.unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(B, V, P, 1, 1)
+        self._mask = Cached_Mask('diag', L, L, device).expand(B, V, P, L, L)
 
     @property
     def mask(self):
@@ -14,9 +70,7 @@ class OffDiagMask_PointLevel():
 
 class OffDiagMask_PatchLevel():
     def __init__(self, B, V, P, device="cpu"):
-        with torch.no_grad():
-            _mask = torch.eye(P, P, dtype=torch.bool).to(device)
-            self._mask = _mask.unsqueeze(0).unsqueeze(0).repeat(B, V, 1, 1)
+        self._mask = Cached_Mask('diag', P, P, device).expand(B, V, P, P)
 
     @property
     def mask(self):
@@ -25,10 +79,7 @@ class OffDiagMask_PatchLevel():
 
 class TriangularCausalMask():
     def __init__(self, B, V, P, L, device="cpu"):
-        with torch.no_grad():
-            mask_shape = [L, L]
-            _mask = torch.triu(torch.ones(mask_shape, dtype=torch.bool), diagonal=1).to(device)
-            self._mask = _mask.unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(B, V, P, 1, 1)
+        self._mask = Cached_Mask('causal', L, L, device).expand(B, V, P, L, L)
 
     @property
     def mask(self):
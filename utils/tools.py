@@ -1,3 +1,7 @@
+import time
+import queue
+import threading
+
 import numpy as np
 import torch
 
@@ -52,6 +56,86 @@ class EarlyStopping:
         self.val_loss_min = val_loss
 
 
+class Prefetcher:
+    """
+    Iterates a DataLoader on a background thread that keeps up to depth batches ready: floating tensors are
+    converted to contiguous float32 (and pinned with pin_memory), so the training loop only moves them to the
+    device. With depth 0 the loader is iterated inline. wait_time is the time the last iteration spent waiting
+    for batches.
+    """
+    def __init__(self, loader, depth=2, pin_memory=False):
+        self.loader = loader
+        self.depth = depth
+        self.pin_memory = pin_memory
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, batch):
+        tensors = []
+        for tensor in batch:
+            if tensor.is_floating_point():
+                tensor = tensor.float()
+            tensor = tensor.contiguous()
+            if self.pin_memory:
+                tensor = tensor.pin_memory()
+            tensors.append(tensor)
+        return tensors
+
+    @staticmethod
+    def _put(ready, item, stop):
+        # put item once there is room, unless the consumer stopped first
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterator, ready, stop):
+        try:
+            for batch in iterator:
+                if not self._put(ready, self._prepare(batch), stop):
+                    return
+            self._put(ready, None, stop)
+        except Exception as e:
+            self._put(ready, e, stop)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        # the iterator (and the shuffling of the sampler) is created in the calling thread, so that the random
+        # state consumed is the same as without prefetching
+        iterator = iter(self.loader)
+        if self.depth <= 0:
+            while True:
+                wait_start = time.time()
+                try:
+                    batch = self._prepare(next(iterator))
+                except StopIteration:
+                    return
+                self.wait_time += time.time() - wait_start
+                yield batch
+
+        ready = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(iterator, ready, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                wait_start = time.time()
+                batch = ready.get()
+                self.wait_time += time.time() - wait_start
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+
+
 def SMAPE_loss(pred, true):
     divide = torch.abs(pred - true) / (torch.abs(pred) + torch.abs(true))
     divide[divide != divide] = .0